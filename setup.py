@@ -8,18 +8,40 @@ from setuptools import setup
 
 
 CURRENT_DIR = os.path.abspath(os.path.dirname(__file__))
+_UNSET = object()
 
 
-def get_long_description():
-    with open(os.path.join(CURRENT_DIR, "README.md"), "r") as ld_file:
-        return ld_file.read()
+class _LazyStr(object):
+    """
+    Stands in for the contents of the file at `path`, which is only read the
+    first time setuptools actually uses it (e.g. when writing metadata), so
+    commands like `setup.py --name` never touch README.md.
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self._value = _UNSET
+
+    def __str__(self):
+        if self._value is _UNSET:
+            with open(self._path, "rb") as f:
+                self._value = f.read().decode("utf-8")
+        return self._value
+
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        return getattr(str(self), name)
+
+
+LONG_DESCRIPTION = _LazyStr(os.path.join(CURRENT_DIR, "README.md"))
 
 
 setup(
     name="xar",
     version="20.12.2",
     description="The XAR packaging toolchain.",
-    long_description=get_long_description(),
+    long_description=LONG_DESCRIPTION,
     long_description_content_type="text/markdown",
     author="Chip Turner",
     author_email="chip@fb.com",
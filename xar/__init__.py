@@ -4,3 +4,42 @@
 # LICENSE file in the root directory of this source tree.
 
 from __future__ import absolute_import, division, print_function, unicode_literals
+
+import importlib
+
+
+# Submodules and public names are resolved on first attribute access (PEP 562)
+# so that `import xar` stays cheap, and setuptools only pulls in bdist_xar and
+# its dependencies when the command is actually used.
+_LAZY_ATTRIBUTES = {"bdist_xar": ("xar.commands.bdist_xar", "bdist_xar")}
+
+_LAZY_SUBMODULES = (
+    "bootstrap_py",
+    "commands",
+    "compat",
+    "finders",
+    "make_xar",
+    "pip_installer",
+    "py_util",
+    "utils",
+    "xar_builder",
+    "xar_util",
+)
+
+__all__ = sorted(list(_LAZY_ATTRIBUTES) + list(_LAZY_SUBMODULES))
+
+
+def __getattr__(name):
+    if name in _LAZY_ATTRIBUTES:
+        module_name, attr = _LAZY_ATTRIBUTES[name]
+        value = getattr(importlib.import_module(module_name), attr)
+    elif name in _LAZY_SUBMODULES:
+        value = importlib.import_module("%s.%s" % (__name__, name))
+    else:
+        raise AttributeError("module %r has no attribute %r" % (__name__, name))
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -5,13 +5,17 @@
 
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+import string
+
+from xar.compat import PY2
+
 
 BOOTSTRAP_XAR = "bootstrap_xar.sh"
 RUN_XAR_MAIN = "__run_xar_main__.py"
 
-BOOTSTRAP_XAR_TEMPLATE = """#!/bin/sh -eu
+_BOOTSTRAP_XAR_HEAD = b"""#!/bin/sh -eu
 
-readlink_e() {{
+readlink_e() {
     local path="$1"
     readlink -e "$path" 2>/dev/null && return
 
@@ -19,10 +23,10 @@ readlink_e() {{
     # so use pwd -P with some recursive readlinking
 
     # strip trailing /
-    path="${{path%/}}"
+    path="${path%/}"
 
     # make path an absolute path
-    if [[ "${{path:0:1}}" != "/" ]]
+    if [[ "${path:0:1}" != "/" ]]
     then
         path="$(pwd -P)/$path"
     fi
@@ -39,12 +43,12 @@ readlink_e() {{
         counter=$(( counter + 1 ))
 
         target="$(readlink "$path")"
-        if [[ "${{target:0:1}}" == "/" ]]
+        if [[ "${target:0:1}" == "/" ]]
         then
             path="$target"
         else
             slash_basename="/$(basename "$path")"
-            path="${{path%$slash_basename}}/$target"
+            path="${path%$slash_basename}/$target"
         fi
     done
 
@@ -54,23 +58,23 @@ readlink_e() {{
     then
         slash_basename=""
     fi
-    local parent_dir="${{path%$slash_basename}}"
+    local parent_dir="${path%$slash_basename}"
 
     # subshell to preserve the cwd (instead of pushd/popd)
     (cd "$parent_dir"; echo "$(pwd -P)$slash_basename")
-}}
+}
 
 BOOTSTRAP_PATH="$0"
 ORIGINAL_EXECUTABLE="$1"; shift
 DIR=$(dirname "$BOOTSTRAP_PATH")
 
 # Save any existing LD_LIBRARY_PATH
-if [ -n "${{LD_LIBRARY_PATH+SET}}" ]; then
+if [ -n "${LD_LIBRARY_PATH+SET}" ]; then
   export XAR_SAVED_LD_LIBRARY_PATH=$LD_LIBRARY_PATH
 fi
 
 # Don't inherit PYTHONPATH.  We set it to be the XAR mountpoint.
-if [ -n "${{PYTHONPATH+SET}}" ]; then
+if [ -n "${PYTHONPATH+SET}" ]; then
   export XAR_SAVED_PYTHONPATH=$PYTHONPATH
 fi
 
@@ -79,24 +83,63 @@ export LD_LIBRARY_PATH="$DIR"
 export PYTHONPATH="$DIR"
 export XAR_RUNTIME_FILES
 XAR_RUNTIME_FILES="$(dirname "$(readlink_e "$BOOTSTRAP_PATH")")"
-export XAR_PYTHON_COMMAND="{python}"
-
-exec {python} "$DIR/{run_xar_main}" "$@"
-"""
-
-
-def run_xar_main(**kwargs):
+export XAR_PYTHON_COMMAND=\""""
+_BOOTSTRAP_XAR_EXEC = b'"\n\nexec '
+_BOOTSTRAP_XAR_RUN_XAR_MAIN = b' "$DIR/'
+_BOOTSTRAP_XAR_TAIL = b'" "$@"\n'
+
+
+# Deprecated: use bootstrap_xar(). Kept, with the same {python} and
+# {run_xar_main} fields, for callers that format the script themselves.
+BOOTSTRAP_XAR_TEMPLATE = "".join(
+    (
+        _BOOTSTRAP_XAR_HEAD.decode("utf-8").replace("{", "{{").replace("}", "}}"),
+        "{python}",
+        _BOOTSTRAP_XAR_EXEC.decode("utf-8"),
+        "{python}",
+        _BOOTSTRAP_XAR_RUN_XAR_MAIN.decode("utf-8"),
+        "{run_xar_main}",
+        _BOOTSTRAP_XAR_TAIL.decode("utf-8"),
+    )
+)
+
+
+def bootstrap_xar(python, run_xar_main):
     """
-    Constructs the run_xar_main given the template arguments.
-    If the {function} template argument is present, then the entry point
-    {module}.{function}() is executed as main. Otherwise, {module} is run as the
-    main module.
+    Returns the bootstrap shell script, encoded as UTF-8, that runs
+    `run_xar_main` with the `python` interpreter. The script is joined from
+    pre-encoded segments rather than formatted from a template, since there
+    are only a couple of substitutions.
     """
-    run_xar_main = """
+    python = python.encode("utf-8")
+    return b"".join(
+        (
+            _BOOTSTRAP_XAR_HEAD,
+            python,
+            _BOOTSTRAP_XAR_EXEC,
+            python,
+            _BOOTSTRAP_XAR_RUN_XAR_MAIN,
+            run_xar_main.encode("utf-8"),
+            _BOOTSTRAP_XAR_TAIL,
+        )
+    )
+
+
+# XARs always run with the same major Python version that built them (see
+# PythonXarBuilder.set_interpreter()), so the __future__ imports are only
+# emitted when building on Python 2, where they actually change behavior.
+if PY2:
+    _RUN_XAR_MAIN_FUTURE = """
 from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
+"""
+else:
+    _RUN_XAR_MAIN_FUTURE = ""
 
+_RUN_XAR_MAIN_PREFIX = (
+    _RUN_XAR_MAIN_FUTURE
+    + """
 
 # Put everything inside an __invoke_main() function.
 # This way anything we define won't pollute globals(), since runpy
@@ -104,7 +147,6 @@ from __future__ import print_function
 def __invoke_main():
     import fcntl
     import os
-    import shlex
     import sys
 
     sys.argv[0] = os.getenv("XAR_INVOKED_NAME")
@@ -118,20 +160,51 @@ def __invoke_main():
         flags = fcntl.fcntl(fd, fcntl.F_GETFD)
         fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
 """
-    if "function" in kwargs:
-        run_xar_main += """
-    import {module}
-    {module}.{function}()
+)
+
+_RUN_XAR_MAIN_SUFFIX = """
+
+__invoke_main()
 """
-    else:
-        run_xar_main += """
+
+_RUN_XAR_MAIN_FUNC_TMPL = string.Template(
+    _RUN_XAR_MAIN_PREFIX
+    + """
+    import ${module}
+    ${module}.${function}()
+"""
+    + _RUN_XAR_MAIN_SUFFIX
+)
+
+_RUN_XAR_MAIN_MODULE_TMPL = string.Template(
+    _RUN_XAR_MAIN_PREFIX
+    + """
     import runpy
-    module = "{module}"
+    module = "${module}"
     runpy._run_module_as_main(module, False)
 """
-    run_xar_main += """
+    + _RUN_XAR_MAIN_SUFFIX
+)
 
-__invoke_main()
-"""
 
-    return run_xar_main.format(**kwargs)
+# Maps (module, function) to the generated __run_xar_main__.py, which only
+# depends on the entry point.
+_RUN_XAR_MAIN_CACHE = {}
+
+
+def run_xar_main(**kwargs):
+    """
+    Constructs the run_xar_main given the template arguments.
+    If the $function template argument is present, then the entry point
+    $module.$function() is executed as main. Otherwise, $module is run as the
+    main module.
+    """
+    key = (kwargs["module"], kwargs.get("function"))
+    source = _RUN_XAR_MAIN_CACHE.get(key)
+    if source is None:
+        if "function" in kwargs:
+            source = _RUN_XAR_MAIN_FUNC_TMPL.substitute(kwargs)
+        else:
+            source = _RUN_XAR_MAIN_MODULE_TMPL.substitute(kwargs)
+        _RUN_XAR_MAIN_CACHE[key] = source
+    return source
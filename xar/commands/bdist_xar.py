@@ -9,13 +9,13 @@ from __future__ import absolute_import, division, print_function
 import copy
 import os
 import sys
-from distutils import log
-from distutils.dir_util import mkpath, remove_tree
-from distutils.errors import DistutilsOptionError
 
-import pkg_resources
 from setuptools import Command
-from xar import finders, pip_installer, py_util, xar_builder, xar_util
+
+
+# Most of the imports needed by bdist_xar are deferred until the command is
+# actually finalized or run, so that other setup.py commands, such as
+# --help-commands, don't pay for importing pkg_resources and friends.
 
 
 class bdist_xar(Command):
@@ -37,6 +37,13 @@ class bdist_xar(Command):
             "only one console script build that, otherwise fail.",
         ),
         ("download", None, "Download missing dependencies using pip"),
+        (
+            "download-cache=",
+            None,
+            "Directory to keep the wheels downloaded by --download in, so "
+            "later builds reuse them instead of running pip again, default: "
+            "unset, the downloads are removed with the bdist directory.",
+        ),
         (
             "xar-exec=",
             None,
@@ -52,17 +59,19 @@ class bdist_xar(Command):
         (
             "xar-compression-algorithm=",
             None,
-            "Compression algorithm for XAR file, default: gzip.",
+            "Compression algorithm for XAR file, 'auto' picks zstd if "
+            "mksquashfs supports it, otherwise gzip, default: gzip.",
         ),
         (
             "xar-block-size=",
             None,
-            "Block size used when compressing the XAR file, default: 256K.",
+            "Block size used when compressing the XAR file, default: 1M with "
+            "zstd, otherwise 256K.",
         ),
         (
             "xar-zstd-level=",
             None,
-            "Compression level when zstd compression is used, default: 16.",
+            "Compression level when zstd compression is used, default: 3.",
         ),
         ("bdist-dir=", "b", "directory for building creating the distribution."),
         (
@@ -93,6 +102,7 @@ class bdist_xar(Command):
         self.console_scripts = None
         self.interpreter = None
         self.download = False
+        self.download_cache = None
         # XAR options
         self.xar_exec = None
         self.xar_mount_root = None
@@ -101,6 +111,9 @@ class bdist_xar(Command):
         self.xar_zstd_level = None
 
     def finalize_options(self):
+        import pkg_resources
+        from xar import finders, xar_util
+
         if self.bdist_dir is None:
             bdist_base = self.get_finalized_command("bdist").bdist_base
             self.bdist_dir = os.path.join(bdist_base, "xar")
@@ -111,21 +124,50 @@ class bdist_xar(Command):
         if self.console_scripts is not None:
             self.console_scripts = self.console_scripts.strip().split(",")
         self.sqopts = xar_util.SquashfsOptions()
-        if self.xar_compression_algorithm is not None:
-            self.sqopts.compression_algorithm = self.xar_compression_algorithm
-        else:
-            self.sqopts.compression_algorithm = "gzip"
+        # zstd is opt-in, because the squashfuse that mounts the XAR may not
+        # support it, even where the mksquashfs that builds it does.
+        algorithm = self.xar_compression_algorithm or "gzip"
+        if algorithm == "auto":
+            compressors = xar_util.mksquashfs_compressors(self.sqopts.mksquashfs)
+            algorithm = "zstd" if "zstd" in compressors else "gzip"
+        self.sqopts.compression_algorithm = algorithm
+        if algorithm == "zstd":
+            # zstd at a low level compresses about as well as gzip, but much
+            # faster, and benefits from larger blocks.
+            self.sqopts.zstd_level = 3
+            self.sqopts.block_size = 1024 * 1024
         if self.xar_block_size is not None:
             self.sqopts.block_size = self.xar_block_size
         if self.xar_zstd_level is not None:
             self.sqopts.zstd_level = self.xar_zstd_level
         self.xar_outputs = []
 
+        finders.register_finders()
         self.working_set = pkg_resources.WorkingSet(sys.path)
+        self._deps_cache = {}
         self.installer = None
         if self.download:
-            bdist_pip = os.path.join(self.bdist_dir, "downloads")
-            mkpath(bdist_pip)
+            from distutils import log
+            from xar import pip_installer
+
+            if self.download_cache is not None:
+                from xar.vendor.wheel import pep425tags
+
+                # Wheels are only shared between builds for the same
+                # interpreter, ABI and platform, e.g. cp37-cp37m-linux_x86_64.
+                bdist_pip = os.path.join(
+                    os.path.expanduser(self.download_cache),
+                    "%s%s-%s-%s"
+                    % (
+                        pep425tags.get_abbr_impl(),
+                        pep425tags.get_impl_ver(),
+                        pep425tags.get_abi_tag() or "none",
+                        pep425tags.get_platform(),
+                    ),
+                )
+            else:
+                bdist_pip = os.path.join(self.bdist_dir, "downloads")
+            xar_util.safe_mkdir(bdist_pip)
             self.installer = pip_installer.PipInstaller(
                 bdist_pip, self.working_set, log
             )
@@ -134,6 +176,8 @@ class bdist_xar(Command):
         return self.xar_outputs
 
     def _add_distribution(self, xar):
+        from xar import py_util
+
         bdist_wheel = self.reinitialize_command("bdist_wheel")
         bdist_wheel.skip_build = self.skip_build
         bdist_wheel.keep_temp = self.keep_temp
@@ -143,6 +187,9 @@ class bdist_xar(Command):
         bdist_wheel.exclude_source_files = self.exclude_source_files
         bdist_wheel.distribution.dist_files = []
         self.run_command("bdist_wheel")
+        # The package is built now, so don't rebuild it if the wheel is
+        # needed again (bdist_wheel already skips byte-compiling).
+        self.skip_build = True
         assert len(bdist_wheel.distribution.dist_files) == 1
         wheel = bdist_wheel.distribution.dist_files[0][2]
         dist = py_util.Wheel(location=wheel).distribution
@@ -153,9 +200,22 @@ class bdist_xar(Command):
         """
         Get a map of console scripts to build based on :self.console_scripts:.
         """
+        from distutils.errors import DistutilsOptionError
+
+        import pkg_resources
+
         name = self.distribution.get_name()
         all_console_scripts = []
         entry_points = self.distribution.entry_points
+        # Only parse the console_scripts group, and don't parse at all if it
+        # can't be present.
+        if isinstance(entry_points, dict):
+            if "console_scripts" in entry_points:
+                entry_points = {"console_scripts": entry_points["console_scripts"]}
+            else:
+                entry_points = None
+        elif entry_points and "[console_scripts]" not in entry_points:
+            entry_points = None
         if entry_points:
             entry_points = pkg_resources.EntryPoint.parse_map(entry_points)
             all_console_scripts = entry_points.get("console_scripts", {})
@@ -184,11 +244,32 @@ class bdist_xar(Command):
         xar.set_entry_point(entry_point_str)
 
     def _deps(self, dist, extras=()):
+        """
+        Returns the set of distributions `dist` depends on with `extras`.
+        Resolutions are cached, since every entry point resolves the same
+        requirements, possibly with a few extras added, and only those extra
+        requirements are resolved on top of the base dependencies.
+        """
+        from distutils import log
+
+        import pkg_resources
+
+        key = (dist.project_name, frozenset(extras))
+        if key in self._deps_cache:
+            return set(self._deps_cache[key])
         requires = dist.requires(extras=extras)
+        base_deps = set()
+        if extras:
+            # Only resolve the requirements the extras add on top of the
+            # (cached) base dependencies, rather than the whole tree again.
+            base_requires = set(dist.requires())
+            base_deps = self._deps(dist)
+            requires = [req for req in requires if req not in base_requires]
+        if self.installer is not None:
+            self.installer.prefetch(requires)
         try:
-            finders.register_finders()
             # Requires setuptools>=34.1 for the bug fix.
-            return set(
+            deps = base_deps | set(
                 self.working_set.resolve(
                     requires, extras=extras, installer=self.installer
                 )
@@ -203,26 +284,83 @@ class bdist_xar(Command):
                 % (name, requires_str, name)
             )
             raise
+        self._deps_cache[key] = deps
+        return set(deps)
+
+    def _extra_deps(self, dist, common_deps, entry_points):
+        """
+        Returns a map from each distinct set of extras used by `entry_points`
+        to the dependencies it adds on top of `common_deps`. Everything is
+        resolved up front, once per set of extras, so that missing
+        requirements are reported before any XAR is staged.
+        """
+        extra_deps = {}
+        for entry_point in entry_points.values():
+            extras = frozenset(entry_point.extras)
+            if extras not in extra_deps:
+                deps = self._deps(dist, tuple(entry_point.extras))
+                extra_deps[extras] = deps - common_deps
+        return extra_deps
+
+    def _prepare_entry_point(self, base_xar, deps, entry_point):
+        """
+        Returns a clone of `base_xar` with the extra dependencies `deps` of
+        `entry_point` added and its entry point set, ready to be built.
+        """
+        from distutils import log
 
-    def _build_entry_point(self, base_xar, dist, common_deps, entry_name, entry_point):
         # Clone the base xar
-        xar = copy.deepcopy(base_xar)
+        xar = base_xar.clone()
         # Add in any extra dependencies
-        deps = self._deps(dist, entry_point.extras)
-        deps -= common_deps
         for dep in deps:
             log.info("adding dependency '%s' to xar" % dep.project_name)
             xar.add_distribution(dep)
         # Set the entry point
         self._set_entry_point(xar, entry_point)
-        # Build the XAR
-        xar_output = os.path.join(self.dist_dir, entry_name + ".xar")
-        mkpath(self.dist_dir)
-        log.info("creating xar '%s'" % xar_output)
-        xar.build(xar_output, self.sqopts)
-        self.xar_outputs.append(xar_output)
+        return xar
+
+    def _build_xars(self, builds):
+        """
+        Builds each `(xar, xar_output)` in `builds`. The builds are independent
+        and dominated by compression, so they are run in parallel processes
+        when there is more than one.
+        """
+        from distutils import log
+
+        from xar import xar_util
+
+        try:
+            for _, xar_output in builds:
+                log.info("creating xar '%s'" % xar_output)
+            sqopts = self.sqopts
+            if len(builds) > 1:
+                # Freeze the XARs here, one at a time, because freezing
+                # byte-compiles them with a pool of processes of its own. The
+                # workers then only run mksquashfs, and the processors are
+                # split between them.
+                for xar, _ in builds:
+                    xar.freeze()
+                sqopts = copy.copy(sqopts)
+                if sqopts.processors is None:
+                    sqopts.processors = max(1, xar_util.cpu_count() // len(builds))
+            self.xar_outputs.extend(
+                xar_util.process_map(
+                    _build_xar,
+                    [(xar, xar_output, sqopts) for xar, xar_output in builds],
+                )
+            )
+        finally:
+            # A built XAR has already deleted its temporary files, but one that
+            # failed, or was never built, hasn't.
+            for xar, _ in builds:
+                xar.delete()
 
     def run(self):
+        from distutils import log
+        from distutils.dir_util import remove_tree
+
+        from xar import xar_builder, xar_util
+
         try:
             xar = xar_builder.PythonXarBuilder(self.xar_exec, self.xar_mount_root)
             # Build an egg for this package and import it.
@@ -235,11 +373,34 @@ class bdist_xar(Command):
             # Set the interpreter to the current python interpreter
             if self.interpreter is not None:
                 xar.set_interpreter(self.interpreter)
-            # Build a XAR for each entry point specified
+            # Set up a XAR for each entry point specified
             entry_points = self._parse_console_scripts()
+            extra_deps = self._extra_deps(dist, deps, entry_points)
+            xar_util.safe_mkdir(self.dist_dir)
+            builds = []
             for entry_name, entry_point in entry_points.items():
-                self._build_entry_point(xar, dist, deps, entry_name, entry_point)
+                ep_deps = extra_deps[frozenset(entry_point.extras)]
+                builds.append(
+                    (
+                        self._prepare_entry_point(xar, ep_deps, entry_point),
+                        os.path.join(self.dist_dir, entry_name + ".xar"),
+                    )
+                )
+            # Every entry point has its own copy now
+            xar.delete()
+            # Build the XARs
+            self._build_xars(builds)
         finally:
             # Clean up the build directory
             if not self.keep_temp:
                 remove_tree(self.bdist_dir)
+
+
+def _build_xar(build):
+    """
+    Builds the `(xar, xar_output, sqopts)` in `build`, and returns
+    `xar_output`. Runs in a worker process.
+    """
+    xar, xar_output, sqopts = build
+    xar.build(xar_output, sqopts)
+    return xar_output
@@ -30,31 +30,57 @@ process.
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 import errno
-import fcntl
-import glob
 import logging
 import optparse
 import os
 import re
-import signal
-import subprocess
 import sys
 import time
 
 
-attr_re = re.compile(r'^([a-zA-Z_]+)="(.*)"')
+attr_re = re.compile(br'^([a-zA-Z_]+)="(.*)"')
+# Mounts are of the form /prefix/uid-N/UUID-ns-NSID/...
+uuid_re = re.compile(r"uid-\d+/([^/]+)-ns-([^-/]+)$")
+# macOS `mount` output: device, mount point, and filesystem type.
+macos_mount_re = re.compile(r"^(.+?) on (.+) \(([^,)]+)")
+# Characters such as spaces are octal escaped in the mount tables.
+octal_escape_re = re.compile(r"\\([0-7]{3})")
 required_attributes = ("VERSION", "UUID", "OFFSET")
 
 logger = logging.getLogger("tools.xar")
 
 
-def is_mounted(path):
+def _unescape_octal(match):
+    return chr(int(match.group(1), 8))
+
+
+def is_mounted(path, mountpoints=None):
     path = os.path.realpath(path)
+    if mountpoints is not None:
+        return path in mountpoints
     mp_stat = os.stat(path)
     parent_stat = os.stat(os.path.dirname(path))
     return parent_stat.st_dev != mp_stat.st_dev
 
 
+# Returns the set of mount points from /proc/self/mountinfo, or None if it
+# isn't available (e.g. on macOS).
+def linux_mountpoints():
+    try:
+        fh = open("/proc/self/mountinfo")
+    except IOError:
+        return None
+    mountpoints = set()
+    try:
+        for line in fh:
+            parts = line.split()
+            if len(parts) >= 5:
+                mountpoints.add(octal_escape_re.sub(_unescape_octal, parts[4]))
+    finally:
+        fh.close()
+    return mountpoints
+
+
 class XarFile:
     def __init__(self, filename):
         self.filename = filename
@@ -68,20 +94,25 @@ class XarFile:
 
     def _read_header(self):
         self.attributes = {}
-        fh = open(self.filename, "rb")
+        # The header fits in the first page; read it with a single read(2)
+        # rather than through a buffered file object.
+        fd = os.open(self.filename, os.O_RDONLY | getattr(os, "O_CLOEXEC", 0))
         try:
-            header = fh.read(4096).split("\n")
-            for line in header:
-                if line == "#xar_stop":
-                    break
-
-                if line[0] == "#":
-                    continue
-                m = attr_re.match(line)
-                if m:
-                    self.attributes[m.group(1)] = m.group(2)
+            header = os.read(fd, 4096)
         finally:
-            fh.close()
+            os.close(fd)
+        for line in header.split(b"\n"):
+            line = line.rstrip(b"\r")
+            if line == b"#xar_stop":
+                break
+
+            # Only attribute lines are worth handing to the regex.
+            if not line or line[:1] == b"#":
+                continue
+            m = attr_re.match(line)
+            if m:
+                name = m.group(1).decode("ascii")
+                self.attributes[name] = m.group(2).decode("ascii", "replace")
 
         for attr in required_attributes:
             if attr not in self.attributes:
@@ -92,16 +123,19 @@ class XarFile:
         self.dependencies = []
         self.optional_dependencies = []
 
-    def mount(self, xarexec):
-        logger.info("Mounting %s with %s" % (self.filename, xarexec))
+    def mount(self, xarexec_args):
+        """Mounts the XAR with the xarexec command line `xarexec_args`."""
+        import subprocess
+
+        logger.info("Mounting %s with %s" % (self.filename, " ".join(xarexec_args)))
         proc = subprocess.Popen(
-            [xarexec.split(), "-m", self.filename], stdout=subprocess.PIPE
+            xarexec_args + ["-m", self.filename], stdout=subprocess.PIPE
         )
         stdout, _ = proc.communicate()
         if proc.returncode != 0:
             logger.fatal("Mount of %s failed, see stderr for details" % self.filename)
             return False
-        self.mountpoint = stdout.split("\n")[0].strip()
+        self.mountpoint = stdout.split(b"\n", 1)[0].strip().decode("utf-8")
         return True
 
     def symlink(self, destdir):
@@ -114,20 +148,28 @@ class XarFile:
 
 
 # flock a file descriptor of the given type within timeout_sec.
-# Return True if successful.  Uses alarm rather than hammering the
-# lock with a polling nonblocking check.
+# Return True if successful.  Polls with a nonblocking flock and an
+# exponential backoff, rather than interrupting a blocking flock with
+# SIGALRM, so that it can be used from any thread.
 def flock_with_timeout(lock_fd, lock_type, timeout_sec):
-    signal.signal(signal.SIGALRM, lambda sig, fr: None)
-    signal.alarm(timeout_sec)
-    try:
-        fcntl.flock(lock_fd, fcntl.LOCK_EX)
-        return True
-    except IOError as ie:
-        if ie.errno != errno.EINTR:
-            logging.error("Unexpected signal during flock: %s" % ie.strerror)
-        return False
-    finally:
-        signal.alarm(0)
+    import fcntl
+
+    clock = getattr(time, "monotonic", time.time)
+    deadline = clock() + timeout_sec
+    delay = 0.01
+    while True:
+        try:
+            fcntl.flock(lock_fd, lock_type | fcntl.LOCK_NB)
+            return True
+        except IOError as ie:
+            if ie.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                logging.error("Unexpected error during flock: %s" % ie.strerror)
+                return False
+        remaining = deadline - clock()
+        if remaining <= 0:
+            return False
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, 1.0)
 
 
 # Check whether a mount point should be unmounted.  We only consider
@@ -135,6 +177,8 @@ def flock_with_timeout(lock_fd, lock_type, timeout_sec):
 # (should_unmount, lock_fd) of whether to unmount and a descriptor
 # holding a flock (which should be closed after the unmount).
 def should_unmount(devname, mountpath, fstype, timeout):
+    import fcntl
+
     if fstype not in (
         "fuse.squashfuse",
         "fuse.squashfuse_ll",
@@ -161,8 +205,7 @@ def should_unmount(devname, mountpath, fstype, timeout):
 
     # Mounts are of the form /prefix/uid-N/UUID-ns-NSID/... -- we need to
     # extract the UUID portion.
-    uuid_regex = re.compile(r"uid-\d+/([^/]+)-ns-([^-/]+)$")
-    match = uuid_regex.match(mount_suffix)
+    match = uuid_re.match(mount_suffix)
     if not match:
         logger.info("Skipping unmount of %s, unexpected path strucure" % mountpath)
         return (False, None)
@@ -212,11 +255,9 @@ def should_unmount(devname, mountpath, fstype, timeout):
             return (True, None)
         raise
 
-    if time.time() - st.st_mtime <= timeout * 60:
-        logger.info(
-            "Skipping unmount of %s, too recent (%.2fs)"
-            % (mountpath, time.time() - st.st_mtime)
-        )
+    age = time.time() - st.st_mtime
+    if age <= timeout * 60:
+        logger.info("Skipping unmount of %s, too recent (%.2fs)" % (mountpath, age))
         os.close(lock_fd)
         return (False, None)
 
@@ -228,10 +269,20 @@ def should_unmount(devname, mountpath, fstype, timeout):
 # Linux-specific cleanup actions - look at /proc/mounts and /etc/mtab
 def linux_mounts():
     # On some systems, /etc/mtab is a symlink to /proc/mounts (which
-    # is symlink ot /proc/self/mounts).  Avoid duplicates via
-    # realpath.
+    # is symlink ot /proc/self/mounts).  Avoid duplicates by comparing
+    # the files' identities, which is a single stat rather than a
+    # realpath walk.
     mounts = []
-    mounts_files = set(os.path.realpath(s) for s in ["/proc/mounts", "/etc/mtab"])
+    mounts_files = []
+    seen = set()
+    for filename in ("/proc/mounts", "/etc/mtab"):
+        try:
+            st = os.stat(filename)
+        except OSError:
+            continue
+        if (st.st_dev, st.st_ino) not in seen:
+            seen.add((st.st_dev, st.st_ino))
+            mounts_files.append(filename)
 
     for filename in mounts_files:
         fh = open(filename)
@@ -242,11 +293,8 @@ def linux_mounts():
                 # mtab can be escaped; fix it up before calling
                 # umount.  Details:
                 # https://gnu.org/software/libc/manual/html_node/mtab.html
-                # Note backslashes are just '\134' and not '\0134'
-                # - special case.
-                mountpath = mountpath.replace("\\134", "\\")
-                for ch in " \t\r\n":
-                    mountpath = mountpath.replace("\\" + oct(ord(ch)), ch)
+                # Note backslashes are just '\134' and not '\0134'.
+                mountpath = octal_escape_re.sub(_unescape_octal, mountpath)
                 mounts.append((devname, mountpath, fstype))
         finally:
             fh.close()
@@ -257,43 +305,82 @@ def linux_mounts():
 # macOS-specific cleanup actions - /proc/mounts not available, easiest way from
 # python is to shellout to `mount` and parse the output.
 def macos_mounts():
-    output = subprocess.check_output(["mount"]).split("\n")
+    import subprocess
+
+    output = subprocess.check_output(["mount"]).decode("utf-8", "replace")
     mounts = []
-    for mount in output:
-        # Skip empty lines
-        if not mount:
-            continue
+    for line in output.splitlines():
+        # Lines look like "device on /mount/point (fstype, options...)"
+        match = macos_mount_re.match(line)
+        if match:
+            mounts.append(match.groups())
 
-        # Device name
-        dev, rest = mount.split(" on ")
-        space = rest.find(" ")
-        if space < 0:
-            continue
+    return mounts
 
-        # Mount point
-        mount_point, stats = rest[0:space], rest[space + 1 :]
 
-        # FS type
-        fstype = stats.strip("()").split(", ")[0]
-        mounts.append((dev, mount_point, fstype))
+# Returns libc's umount2(), or None if it isn't available (e.g. on macOS).
+def _load_umount2():
+    try:
+        import ctypes
+        import ctypes.util
+
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        umount2 = libc.umount2
+    except (ImportError, OSError, AttributeError, TypeError):
+        return None
+    umount2.argtypes = [ctypes.c_char_p, ctypes.c_int]
+    return umount2
+
+
+def _do_unmount(umount2, mountpoint, lock_fd):
+    import subprocess
+
+    logger.info("Attempting to unmount %s..." % mountpoint)
+    # Try the syscall directly to save a fork and exec of umount, which we
+    # still fall back to for the cases it handles, like unprivileged users
+    # unmounting FUSE mounts.
+    if umount2 is None or umount2(mountpoint.encode("utf-8"), 0) != 0:
+        subprocess.call(["umount", mountpoint])
+    try:
+        os.rmdir(mountpoint)
+    except Exception:
+        pass
+    if lock_fd is not None:
+        os.close(lock_fd)
+
 
-    return mounts
+def _unmount_if_stale(umount2, mount, timeout):
+    devname, mountpoint, fstype = mount
+    do_it, lock_fd = should_unmount(devname, mountpoint, fstype, timeout)
+    if do_it:
+        _do_unmount(umount2, mountpoint, lock_fd)
 
 
 # Try unmount everything in `mounts`.
 def unmount(mounts, opts):
-    for mount in mounts:
-        devname, mountpoint, fstype = mount
-        do_it, lock_fd = should_unmount(devname, mountpoint, fstype, opts.timeout)
-        if do_it:
-            logger.info("Attempting to unmount %s..." % mountpoint)
-            subprocess.call(["umount", mountpoint])
-            try:
-                os.rmdir(mountpoint)
-            except Exception:
-                pass
-            if lock_fd is not None:
-                os.close(lock_fd)
+    if not mounts:
+        return
+    umount2 = _load_umount2()
+
+    # Waiting for a mount's lock or tearing down a FUSE mount can block for
+    # a while, so check and unmount in parallel when concurrent.futures is
+    # available.
+    try:
+        from concurrent import futures
+    except ImportError:
+        # Python 2 without the futures backport.
+        futures = None
+    if futures is None or len(mounts) == 1:
+        for mount in mounts:
+            _unmount_if_stale(umount2, mount, opts.timeout)
+        return
+    with futures.ThreadPoolExecutor(min(32, len(mounts))) as executor:
+        unmounts = [
+            executor.submit(_unmount_if_stale, umount2, mount, opts.timeout)
+            for mount in mounts
+        ]
+        for unmount_future in unmounts:
+            unmount_future.result()
 
 
 def main(args):
@@ -337,6 +424,8 @@ def main(args):
     filenames = []
     for file_or_dir in files:
         if os.path.isdir(file_or_dir):
+            import glob
+
             filenames.extend(glob.glob(os.path.join(file_or_dir, "*.xar")))
         else:
             filenames.append(file_or_dir)
@@ -350,17 +439,37 @@ def main(args):
             xar_files[xar_file.alias] = xar_file
 
     # Mount each xarfile and, optionally, create our symlink.
+    if xar_files:
+        import shlex
+
+        xarexec_args = shlex.split(opts.xarexec)
     for xar_file in xar_files.values():
-        if xar_file.mount(opts.xarexec) and opts.symlink_dir:
+        if xar_file.mount(xarexec_args) and opts.symlink_dir:
             xar_file.symlink(opts.symlink_dir)
 
     # Remove dangling symlinks; unfortunately this is racey, as it
     # cannot be done atomically (ie we can't remove the symlink only
     # if the contents are something we expect).
     if opts.symlink_dir:
-        for entry in os.listdir(opts.symlink_dir):
-            path = os.path.join(opts.symlink_dir, entry)
-            if not os.access(path, os.R_OK) or not is_mounted(path):
+        # Read the mount table once rather than stat'ing every symlink.
+        mountpoints = linux_mountpoints()
+        if hasattr(os, "scandir"):
+            entries = [(e.path, e.is_symlink()) for e in os.scandir(opts.symlink_dir)]
+        else:
+            entries = []
+            for entry in os.listdir(opts.symlink_dir):
+                path = os.path.join(opts.symlink_dir, entry)
+                entries.append((path, os.path.islink(path)))
+        for path, is_link in entries:
+            if not os.access(path, os.R_OK):
+                mounted = False
+            elif is_link and mountpoints and os.readlink(path) in mountpoints:
+                # Our symlinks point straight at the mount point, so there's
+                # no need to resolve them.
+                mounted = True
+            else:
+                mounted = is_mounted(path, mountpoints)
+            if not mounted:
                 logger.info("Removing symlink to unmounted image: %s" % path)
                 os.unlink(path)
 
@@ -9,39 +9,72 @@ import os
 import pkgutil
 import zipimport
 
-import pkg_resources
-from xar import py_util
 
+# pkg_resources is slow to import, and xar.py_util imports it too, so both are
+# imported by the functions that need them rather than with this module.
 
-try:
-    import importlib.machinery as importlib_machinery
 
-    # access attribute to force import under delayed import mechanisms.
-    importlib_machinery.__name__
-except ImportError:
-    importlib_machinery = None
+def find_wheels_in_zip(importer, path_item, only=False):
+    from xar import py_util
+
+    # Only a wheel archive can be a wheel, so don't go reading the zip of
+    # any other zipimport path just to fail.
+    if not py_util.Wheel.is_wheel_archive(path_item):
+        return
+    # A broken archive (zipimport.ZipImportError) or a badly named wheel
+    # (wheel's BadWheelFile is a ValueError) is skipped.
+    try:
+        wheel = py_util.Wheel(location=path_item, importer=importer)
+    except (ImportError, OSError, ValueError, py_util.Wheel.Error):
+        return
+    yield wheel.distribution
 
 
-def find_wheels_in_zip(importer, path_item, only=False):
+# Suffixes of the directory entries that pkg_resources.find_on_path() can turn
+# into distributions.
+_DIST_SUFFIXES = (".egg", ".egg-info", ".dist-info", ".egg-link")
+
+
+def _listdir(path_item):
+    # Any directory we can't list is skipped, as pkg_resources does.
     try:
-        yield py_util.Wheel(location=path_item, importer=importer).distribution
-    except Exception:
-        pass
+        return os.listdir(path_item)
+    except OSError:
+        return []
+
+
+def _find_wheels(path_item, names):
+    import pkg_resources
+    from xar import py_util
+
+    # Wheels are recognized by name alone, so nothing needs to be stat'ed.
+    is_wheel_archive = py_util.Wheel.is_wheel_archive
+    for name in [name for name in names if is_wheel_archive(name)]:
+        for dist in pkg_resources.find_distributions(os.path.join(path_item, name)):
+            yield dist
 
 
 def find_wheels_on_path(importer, path_item, only=False):
-    if only or not os.path.isdir(path_item) or not os.access(path_item, os.R_OK):
+    if only:
         return
-    for entry in os.listdir(path_item):
-        if py_util.Wheel.is_wheel_archive(entry):
-            location = os.path.join(path_item, entry)
-            for dist in pkg_resources.find_distributions(location):
-                yield dist
+    for dist in _find_wheels(path_item, _listdir(path_item)):
+        yield dist
 
 
 def find_on_path(importer, path_item, only=False):
-    for finder in (pkg_resources.find_on_path, find_wheels_on_path):
-        for dist in finder(importer, path_item, only):
+    import pkg_resources
+
+    # List the directory once. The wheels come out of this listing, and
+    # pkg_resources.find_on_path(), which lists the directory again, is only
+    # needed when there is egg or dist-info metadata for it to find.
+    names = _listdir(path_item)
+    if path_item.lower().endswith(".egg") or any(
+        name.lower().endswith(_DIST_SUFFIXES) for name in names
+    ):
+        for dist in pkg_resources.find_on_path(importer, path_item, only):
+            yield dist
+    if not only:
+        for dist in _find_wheels(path_item, names):
             yield dist
 
 
@@ -58,9 +91,23 @@ def register_finders():
     if __REGISTERED:
         return
 
+    import pkg_resources
+
+    # importlib.machinery is only needed here, so don't import it with the
+    # module.
+    try:
+        import importlib.machinery as importlib_machinery
+    except ImportError:
+        importlib_machinery = None
+
     pkg_resources.register_finder(zipimport.zipimporter, find_wheels_in_zip)
-    pkg_resources.register_finder(pkgutil.ImpImporter, find_on_path)
-    if hasattr(importlib_machinery, "FileFinder"):
-        pkg_resources.register_finder(importlib_machinery.FileFinder, find_on_path)
+    # pkgutil.ImpImporter is deprecated, and was removed in Python 3.12.
+    path_importers = (
+        getattr(pkgutil, "ImpImporter", None),
+        getattr(importlib_machinery, "FileFinder", None),
+    )
+    for path_importer in path_importers:
+        if path_importer is not None:
+            pkg_resources.register_finder(path_importer, find_on_path)
 
     __REGISTERED = True
@@ -31,9 +31,11 @@ import argparse
 import logging
 import os
 import sys
-import zipfile
 
-from xar import py_util, xar_builder, xar_util
+
+# The xar modules (xar_builder pulls in pkg_resources) and zipfile are
+# imported by main() only once the arguments are parsed, so that --help and
+# argument errors are quick.
 
 
 class XarArgumentError(Exception):
@@ -108,12 +110,18 @@ def main(args=None):
     )
     opts = p.parse_args(args)
 
+    from xar import xar_builder, xar_util
+
     squashfs_options = xar_util.SquashfsOptions()
     squashfs_options.compression_algorithm = opts.xar_compression_algorithm
     squashfs_options.block_size = opts.xar_block_size
     squashfs_options.zstd_level = opts.xar_zstd_level
 
     if opts.python:
+        import zipfile
+
+        from xar import py_util
+
         xar = xar_builder.PythonXarBuilder(opts.xar_exec, opts.xar_mount_root)
         interpreter = opts.python_interpreter
         entry_point = opts.python_entry_point
@@ -123,10 +131,10 @@ def main(args=None):
             xar.add_directory(opts.python)
             entry_point = entry_point or py_util.get_python_main(opts.python)
         else:
-            z_interpreter, z_entry_point = py_util.extract_python_archive_info(
-                opts.python
-            )
             with zipfile.ZipFile(opts.python) as zf:
+                z_interpreter, z_entry_point = py_util.extract_python_archive_info(
+                    opts.python, zf
+                )
                 interpreter = interpreter or z_interpreter
                 entry_point = entry_point or z_entry_point
                 xar.add_zipfile(zf)
@@ -5,8 +5,6 @@
 
 from __future__ import absolute_import, division, print_function
 
-import contextlib
-import multiprocessing
 import os
 import subprocess
 import sys
@@ -18,6 +16,17 @@ import pkg_resources
 from xar import finders, py_util, xar_util
 
 
+# tarfile copies members out 16 KiB at a time by default.
+_TAR_COPY_BUFSIZE = 1024 * 1024
+
+
+def _open_tar(sdist):
+    archive = tarfile.TarFile.open(sdist)
+    # Only Python 3.8+ reads copybufsize, older versions ignore it.
+    archive.copybufsize = _TAR_COPY_BUFSIZE
+    return archive
+
+
 class PipException(Exception):
     pass
 
@@ -40,27 +49,36 @@ class PipInstaller:
         self._dest = dest
         self._working_set = working_set
         self._log = log
-        self._working_set.add_entry(self._dest)
-        req = pkg_resources.Requirement.parse("pip")
-        dist = self._working_set.find(req)
-        self._pip_main = pkg_resources.load_entry_point(dist, "console_scripts", "pip")
+        # The non-wheels this installer downloaded and hasn't built yet. `dest`
+        # may be a cache shared between builds, so nothing else in it is
+        # built or removed.
+        self._sdists = set()
 
     def clean(self):
         """
-        Remove any non-wheels from the downloads directory.
+        Remove the non-wheels this installer downloaded but didn't build.
         """
-        for entry in os.listdir(self._dest):
-            if not py_util.Wheel.is_wheel_archive(entry):
-                xar_util.safe_remove(os.path.join(self._dest, entry))
+        for path in self._sdists:
+            xar_util.safe_remove(path)
+        self._sdists.clear()
 
-    def invoke_pip(self, args):
-        def main(args):
-            sys.exit(self._pip_main(args))
+    def _add_sdists(self, before):
+        """
+        Records the non-wheels added to the downloads directory since it held
+        the names in `before`.
+        """
+        # Wheels are recognized by name alone, so nothing needs to be stat'ed.
+        is_wheel_archive = py_util.Wheel.is_wheel_archive
+        for name in os.listdir(self._dest):
+            if name not in before and not is_wheel_archive(name):
+                self._sdists.add(os.path.join(self._dest, name))
 
-        p = multiprocessing.Process(target=main, args=(args,))
-        p.start()
-        p.join()
-        if p.exitcode == 0:
+    def invoke_pip(self, args):
+        """
+        Run pip with `args` in a child interpreter, rather than forking this
+        process, which may have a lot of state by now, just to call pip.
+        """
+        if subprocess.call([sys.executable, "-m", "pip"] + list(args)) == 0:
             return
         raise PipException("'pip %s' failed" % " ".join(args))
 
@@ -68,7 +86,14 @@ class PipInstaller:
         """
         Download the requirement to the downloads directory using pip.
         """
-        args = ["download", "-d", self._dest, str(requirement)]
+        self.download_many([requirement])
+
+    def download_many(self, requirements):
+        """
+        Download all the requirements to the downloads directory with a single
+        pip invocation, so pip resolves them together.
+        """
+        args = ["download", "-d", self._dest] + [str(req) for req in requirements]
         self.invoke_pip(args)
 
     def extract_sdist(self, sdist, dest):
@@ -80,23 +105,20 @@ class PipInstaller:
             error_cls = zipfile.BadZipfile
         else:
             assert ".tar" in sdist.lower()
-            open_sdist = tarfile.TarFile.open
+            open_sdist = _open_tar
             error_cls = tarfile.ReadError
         try:
-            with contextlib.closing(open_sdist(sdist)) as archive:
+            with open_sdist(sdist) as archive:
                 archive.extractall(path=dest)
-
-            def collapse_trivial(path):
-                entries = os.listdir(path)
-                if len(entries) == 1:
-                    entry = os.path.join(path, entries[0])
-                    if os.path.isdir(entry):
-                        return collapse_trivial(entry)
-                return path
-
-            return collapse_trivial(dest)
         except error_cls:
             raise BuildException("Failed to extract %s" % os.path.basename(sdist))
+        # Descend through directories that only contain a single directory.
+        path = dest
+        while True:
+            names = os.listdir(path)
+            if len(names) != 1 or not os.path.isdir(os.path.join(path, names[0])):
+                return path
+            path = os.path.join(path, names[0])
 
     def build_wheel_from_sdist(self, sdist):
         """
@@ -130,43 +152,114 @@ class PipInstaller:
         finally:
             xar_util.safe_rmtree(temp)
 
-    def find(self, requirement):
+    def _add_downloads(self, requirements):
         """
-        Ensure all built wheels are added to the working set.
-        Return the distribution.
+        Adds the downloaded wheels that `requirements` and their dependencies
+        resolve to to the working set. The downloads directory may hold several
+        versions of a project, so the newest matching one is picked, rather
+        than whichever is listed first. Returns False if they don't resolve.
         """
         finders.register_finders()
-        for dist in pkg_resources.find_distributions(self._dest):
+        # pip only downloads wheels for this interpreter, so don't filter them
+        # by Python version, which wheels only carry the major version of.
+        env = pkg_resources.Environment([self._dest], python=None)
+        try:
+            dists = self._working_set.resolve(requirements, env)
+        except (pkg_resources.DistributionNotFound, pkg_resources.VersionConflict):
+            return False
+        for dist in dists:
             if dist not in self._working_set:
                 self._working_set.add(dist, entry=self._dest)
+        return True
+
+    def find(self, requirement):
+        """
+        Ensure the downloaded wheels for `requirement` are added to the working
+        set. Return the distribution.
+        """
+        self._add_downloads([requirement])
         return self._working_set.find(requirement)
 
+    def _build_sdists(self):
+        """
+        Build wheels for the sdists in the downloads directory (and remove the
+        sdists). Returns False if a build failed.
+        """
+        sdists = sorted(self._sdists)
+
+        def build(sdist):
+            self.build_wheel_from_sdist(sdist)
+            xar_util.safe_remove(sdist)
+
+        # Each build runs in its own setup.py process, so they can all run at
+        # once.
+        try:
+            xar_util.thread_map(build, sdists)
+        except BuildException as e:
+            if self._log:
+                self._log.exception(e)
+            return False
+        self._sdists.clear()
+        return True
+
+    def prefetch(self, requirements):
+        """
+        Downloads every requirement in `requirements` that is missing from the
+        working set (and their dependencies) with a single pip invocation,
+        unless the wheels already downloaded satisfy them, and adds the wheels
+        to the working set. Resolving the requirements
+        afterwards then only calls the installer for whatever is still
+        missing, instead of running pip once per missing requirement.
+        Failures are logged, and left for the resolution to report.
+        """
+        missing = []
+        for requirement in requirements:
+            try:
+                if self._working_set.find(requirement) is None:
+                    missing.append(requirement)
+            except pkg_resources.VersionConflict:
+                # The installer isn't used for conflicts.
+                pass
+        # Wheels already downloaded, possibly by an earlier build, may do.
+        if not missing or self._add_downloads(missing):
+            return
+        self.clean()
+        before = set(os.listdir(self._dest))
+        try:
+            self.download_many(missing)
+        except PipException as e:
+            if self._log:
+                self._log.exception(e)
+            return
+        finally:
+            self._add_sdists(before)
+        self._build_sdists()
+        self._add_downloads(missing)
+
     def __call__(self, requirement):
         """
         Attempts to download the requirement (and its dependencies) and add the
         wheel(s) to the downloads directory and the working set. Returns the
         distribution on success and None on failure.
         """
-        # Remove non-wheels from the download directory
+        # Use a wheel that was already downloaded, possibly by an earlier
+        # build, if there is one.
+        dist = self.find(requirement)
+        if dist is not None:
+            return dist
+        # Remove the non-wheels left by earlier downloads
         self.clean()
         # Attempt to download the wheel/sdist
+        before = set(os.listdir(self._dest))
         try:
             self.download(requirement)
         except PipException as e:
             if self._log:
                 self._log.exception(e)
             return None
-        # Build wheels for the sdists (and remove the sdist)
-        for entry in os.listdir(self._dest):
-            if py_util.Wheel.is_wheel_archive(entry):
-                continue
-            try:
-                sdist = os.path.join(self._dest, entry)
-                self.build_wheel_from_sdist(sdist)
-                xar_util.safe_remove(sdist)
-            except BuildException as e:
-                if self._log:
-                    self._log.exception(e)
-                return None
+        finally:
+            self._add_sdists(before)
+        if not self._build_sdists():
+            return None
         # Return the wheel distribution
         return self.find(requirement)
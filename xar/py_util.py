@@ -15,7 +15,6 @@ import shlex
 import shutil
 import subprocess
 import sys
-import tempfile
 import zipfile
 import zipimport
 
@@ -30,6 +29,7 @@ logger = logging.getLogger("xar")
 
 
 PYTHON_EXTS = [".py", ".pyc", ".pyo"]
+_COMPILED_PYTHON_EXTS = tuple(ext for ext in PYTHON_EXTS if ext != ".py")
 
 
 def parse_entry_point(entry_point):
@@ -55,11 +55,13 @@ def get_python_main(directory):
     return None
 
 
-def extract_python_archive_info(archive):
+def extract_python_archive_info(archive, zf=None):
     """
     Extracts the shebang (if any) from a python archive, along with the entry
     point (if any). Returns a tuple (python_interpreter, entry_point).
     Avoids interpreting the shebang in it doesn't contain 'python'.
+    Pass the archive already opened as a ZipFile `zf` to avoid reading its
+    central directory again.
     """
     python = None
     with open(archive, "rb") as f:
@@ -67,14 +69,21 @@ def extract_python_archive_info(archive):
             shebang = f.readline().decode("utf-8").strip()
             if "python" in shebang:
                 python = shebang
-    with zipfile.ZipFile(archive) as zf:
-        # Ignores __pycache__ since .pyc in __pycache__ aren't executable
-        # without the .py.
-        MAIN = "__main__"
-        main_exists = any(xar_util.file_in_zip(zf, MAIN + ext) for ext in PYTHON_EXTS)
-        if main_exists:
-            return (python, MAIN)
-        return (python, None)
+        if zf is None:
+            # Read the zip directory through the file that is already open.
+            with zipfile.ZipFile(f) as zf:
+                return (python, _python_archive_main(zf))
+    return (python, _python_archive_main(zf))
+
+
+def _python_archive_main(zf):
+    # Ignores __pycache__ since .pyc in __pycache__ aren't executable
+    # without the .py.
+    MAIN = "__main__"
+    main_exists = any(xar_util.file_in_zip(zf, MAIN + ext) for ext in PYTHON_EXTS)
+    if main_exists:
+        return MAIN
+    return None
 
 
 def get_pyc_file(py_file):
@@ -82,6 +91,26 @@ def get_pyc_file(py_file):
     return cache_from_source(py_file, debug_override=True)
 
 
+def _compile_file(py_file):
+    """
+    Compiles `py_file` for :func:`compile_files`. Returns the error message,
+    or None on success.
+    """
+    pyc_file = get_pyc_file(py_file)
+    try:
+        py_compile.compile(py_file, pyc_file, doraise=True)
+        assert os.path.exists(pyc_file)
+        newtime = xar_util.extract_pyc_timestamp(pyc_file)
+        os.utime(py_file, (newtime, newtime))
+    except py_compile.PyCompileError as e:
+        return e.msg
+    return None
+
+
+# Below this many files, starting worker processes costs more than it saves.
+_PARALLEL_COMPILE_MIN_FILES = 64
+
+
 def compile_files(py_files):
     """
     Compiles every Python file in `py_files` into a pyc file.
@@ -89,36 +118,60 @@ def compile_files(py_files):
     Returns a dict of files that errored to the error message.
     Note: Always writes to .pyc, even if optimization is enabled.
     """
-    errors = {}
-    for py_file in py_files:
-        pyc_file = get_pyc_file(py_file)
-        try:
-            py_compile.compile(py_file, pyc_file, doraise=True)
-            assert os.path.exists(pyc_file)
-            newtime = xar_util.extract_pyc_timestamp(pyc_file)
-            os.utime(py_file, (newtime, newtime))
-        except py_compile.PyCompileError as e:
-            errors[py_file] = e.msg
-    return errors
+    py_files = list(py_files)
+    if len(py_files) < _PARALLEL_COMPILE_MIN_FILES:
+        msgs = [_compile_file(py_file) for py_file in py_files]
+    else:
+        # Compiling is CPU bound, and every file is independent.
+        msgs = xar_util.process_map(_compile_file, py_files, chunksize=16)
+    return {
+        py_file: msg for py_file, msg in zip(py_files, msgs) if msg is not None
+    }
+
+
+def _which(name):
+    # shutil.which() is Python 3 only.
+    which = getattr(shutil, "which", None)
+    if which is None:
+        from distutils.spawn import find_executable as which
+    return which(name)
+
+
+_VERSION_INFO_MAIN = "import sys; print('.'.join(str(x) for x in sys.version_info))"
+_PYTHON_VERSIONS = {}
+
+
+def _python_version(interpreter):
+    """
+    Returns the dotted `sys.version_info` of `interpreter`. The interpreter is
+    only run if it isn't the running one, and only once.
+    """
+    if interpreter in _PYTHON_VERSIONS:
+        return _PYTHON_VERSIONS[interpreter]
+    binary = shlex.split(interpreter)
+    executable = None
+    if len(binary) == 1:
+        executable = binary[0]
+    elif len(binary) == 2 and os.path.basename(binary[0]) == "env":
+        executable = _which(binary[1])
+    if executable and os.path.realpath(executable) == os.path.realpath(
+        sys.executable
+    ):
+        version = ".".join(str(x) for x in sys.version_info)
+    else:
+        output = subprocess.check_output(binary + ["-c", _VERSION_INFO_MAIN])
+        version = output.decode("utf-8").strip()
+    _PYTHON_VERSIONS[interpreter] = version
+    return version
 
 
 def is_python_version(interpreter, version_info):
     """
     Returns `True` if `interpreter` is version `version_info`.
-    """
-    VERSION_INFO_MAIN = """
-import sys
-print('.'.join(str(x) for x in sys.version_info))
     """
     assert interpreter is not None
-    with tempfile.NamedTemporaryFile("w+t", delete=False) as f:
-        f.write(VERSION_INFO_MAIN)
-        f.flush()
-        this_version = ".".join(str(x) for x in version_info)
-        binary = shlex.split(interpreter)
-        output = subprocess.check_output(binary + [f.name])
-        other_version = output.decode("utf-8").strip()
-        return this_version == other_version
+    this_version = ".".join(str(x) for x in version_info)
+    return this_version == _python_version(interpreter)
 
 
 # Cribbed from PythonIdentity.hashbang() in PEX.
@@ -142,7 +195,22 @@ def environment_python_interpreter():
 
 
 class WheelMetadata(pkg_resources.EggMetadata):
-    """Metadata provider for zipped wheels."""
+    """
+    Metadata provider for zipped wheels. The wheel is immutable, so metadata
+    files are cached after they are first read out of the archive.
+    """
+
+    def __init__(self, importer):
+        super(WheelMetadata, self).__init__(importer)
+        self._metadata_cache = {}
+
+    def get_metadata(self, name):
+        try:
+            return self._metadata_cache[name]
+        except KeyError:
+            metadata = super(WheelMetadata, self).get_metadata(name)
+            self._metadata_cache[name] = metadata
+            return metadata
 
     def _setup_prefix(self):
         # Cribbed from pkg_resources.EggProvider and pex WheelMetadata.
@@ -155,21 +223,61 @@ class WheelMetadata(pkg_resources.EggMetadata):
                 break
 
 
+_HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def _new_sha256():
+    # RECORD hashes are integrity checks, not security. Saying so keeps the
+    # OpenSSL implementation usable when OpenSSL is in FIPS mode (Python 3.9+).
+    try:
+        return hashlib.sha256(usedforsecurity=False)
+    except TypeError:
+        return hashlib.sha256()
+
+
 def does_sha256_match(file, expected_hash):
     """
     Does `file`'s sha256 match `expected_hash`. The `expected_hash` is expected
     to be in the format of RECORD files: sha256=urlsafe_b64_with_no_trailing_==.
     """
-    h = hashlib.sha256()
-    with open(file, "rb") as f:
-        data = f.read(4096)
-        while data:
-            h.update(data)
-            data = f.read(4096)
+    # Anything else can't match, so don't bother reading the file.
+    if not expected_hash.startswith("sha256="):
+        return False
+    with open(file, "rb", buffering=0) as f:
+        if hasattr(hashlib, "file_digest"):
+            # Python 3.11+ hashes the whole file in C.
+            h = hashlib.file_digest(f, _new_sha256)
+        else:
+            # Read into one reused buffer rather than allocating every chunk.
+            h = _new_sha256()
+            buf = memoryview(bytearray(_HASH_CHUNK_SIZE))
+            n = f.readinto(buf)
+            while n:
+                h.update(buf[:n])
+                n = f.readinto(buf)
     hash = b"sha256=" + base64.urlsafe_b64encode(h.digest()).rstrip(b"=")
     return native(hash) == expected_hash
 
 
+def _link_or_copy(src, dst):
+    """
+    Hard links `src` to `dst`, replacing `dst`, so no data is copied. Falls
+    back to copying when `src` can't be linked, e.g. when it is on another
+    filesystem or owned by another user. Installed files are only ever
+    replaced, not modified in place, so sharing the inode is safe, except for
+    Python sources: compile_files() sets their mtime, which would invalidate
+    the original installation's pyc files, so those are always copied.
+    """
+    xar_util.safe_remove(dst)
+    if not src.endswith(".py"):
+        try:
+            os.link(src, dst)
+            return
+        except OSError:
+            pass
+    shutil.copy2(src, dst)
+
+
 class Wheel:
     """
     Wrapper around a pkg_resources.DistInfoDistribution with Wheel specific
@@ -206,6 +314,7 @@ class Wheel:
 
         if distribution is not None:
             self.distribution = distribution
+            egg_info = distribution.egg_info
         else:
             # Construct the metadata provider
             if self.is_wheel_archive(location):
@@ -214,45 +323,53 @@ class Wheel:
             else:
                 root = os.path.dirname(location)
                 metadata = pkg_resources.PathMetadata(root, location)
-            project_name, version, py_version, platform = [None] * 4
-            match = self.WHEEL_INFO_RE(os.path.basename(metadata.egg_info))
-            if match:
-                project_name, version, py_version, platform = match.group(
-                    "name", "ver", "pyver", "plat"
-                )
-                py_version = py_version or sys.version_info[0]
-            self.distribution = pkg_resources.DistInfoDistribution(
-                location,
-                metadata,
-                project_name=project_name,
-                version=version,
-                py_version=py_version,
-                platform=platform,
-            )
-        # self.distribution.egg_info is the only reliable way to get the name.
+            egg_info = metadata.egg_info
+        # The distribution's egg_info is the only reliable way to get the name.
         # I'm not sure if egg_info is a public interface, but we already rely
-        # on it for WheelMetadata.
-        wheel_info = os.path.basename(self.distribution.egg_info)
+        # on it for WheelMetadata. It is parsed once, for both the Wheel and
+        # the distribution.
+        wheel_info = os.path.basename(egg_info)
         parsed_filename = self.WHEEL_INFO_RE(wheel_info)
         if parsed_filename is None:
             raise self.Error("Bad wheel '%s'" % wheel_info)
         self.name, self.ver, self.namever = parsed_filename.group(
             "name", "ver", "namever"
         )
+        if distribution is None:
+            project_name, version, py_version, platform = parsed_filename.group(
+                "name", "ver", "pyver", "plat"
+            )
+            self.distribution = pkg_resources.DistInfoDistribution(
+                location,
+                metadata,
+                project_name=project_name,
+                version=version,
+                py_version=py_version or sys.version_info[0],
+                platform=platform,
+            )
+        # The WHEEL and RECORD metadata are parsed once, on first use.
+        self._is_purelib = None
+        self._records = None
 
     def is_purelib(self):
         """Returns True if the Wheel is a purelib."""
-        wheel_info = pkginfo.read_pkg_info_bytes(
-            self.distribution.get_metadata(self.WHEEL_INFO).encode("utf-8")
-        )
-        return wheel_info["Root-Is-Purelib"] == "true"
+        if self._is_purelib is None:
+            wheel_info = pkginfo.read_pkg_info_bytes(
+                self.distribution.get_metadata(self.WHEEL_INFO).encode("utf-8")
+            )
+            self._is_purelib = wheel_info["Root-Is-Purelib"] == "true"
+        return self._is_purelib
 
     def records(self):
         """
         Returns an iterator over the records of the Wheel.
         Iterates over triples [filename, hash, size].
         """
-        return csv.reader(self.distribution.get_metadata_lines(self.RECORD))
+        if self._records is None:
+            self._records = list(
+                csv.reader(self.distribution.get_metadata_lines(self.RECORD))
+            )
+        return iter(self._records)
 
     def distinfo_name(self):
         return "%s.dist-info" % self.namever
@@ -356,6 +473,13 @@ class Wheel:
             src_root = src_paths["platlib"]
             dst_root = dst_paths["platlib"]
         assert src_root[:1] == os.sep and dst_root[:1] == os.sep
+        # Normalize the dst paths once, so that every dst_record is normalized
+        # and the ones under dst_root can be made relative by slicing.
+        dst_root = os.path.normpath(dst_root)
+        dst_root_prefix = dst_root + os.sep
+        norm_dst_paths = {
+            kind: os.path.normpath(path) for kind, path in dst_paths.items()
+        }
         # Create or overwrite the dst RECORD file.
         dst_records_path = os.path.join(dst_root, self.distinfo_name(), self.RECORD)
         if os.path.exists(dst_records_path) and not force:
@@ -364,6 +488,7 @@ class Wheel:
         with open(dst_records_path, mode="w+t") as f:
             # Loop over each record in the source distribution.
             dst_records = csv.writer(f)
+            copied = set()
             for record, record_hash, record_size in self.records():
                 # Get the normalized absolute path for the source record
                 src_record = os.path.normpath(os.path.join(src_root, record))
@@ -372,19 +497,24 @@ class Wheel:
                     src_root, src_paths, dst_paths, src_record
                 )
                 rel_record = src_record[len(prefix) + 1 :]
-                dst_record = os.path.join(dst_paths[kind], rel_record)
+                dst_record = os.path.join(norm_dst_paths[kind], rel_record)
                 # Update the destination RECORD file.
-                new_record = os.path.relpath(dst_record, dst_root)
+                if dst_record.startswith(dst_root_prefix):
+                    new_record = dst_record[len(dst_root_prefix) :]
+                else:
+                    new_record = os.path.relpath(dst_record, dst_root)
                 dst_records.writerow((new_record, record_hash, record_size))
-                # Don't write the records file, since we are recreating it.
-                if dst_record == dst_records_path:
+                # Don't write the records file, since we are recreating it,
+                # and don't check or copy a record listed twice again.
+                if dst_record == dst_records_path or dst_record in copied:
                     continue
                 # Copy or overwrite the record
-                if os.path.exists(dst_record) and not force:
+                if not force and os.path.exists(dst_record):
                     if not does_sha256_match(dst_record, record_hash):
                         raise self.Error("'%s' already exists" % dst_record)
                 xar_util.safe_mkdir(os.path.dirname(dst_record))
-                shutil.copy2(src_record, dst_record)
+                _link_or_copy(src_record, dst_record)
+                copied.add(dst_record)
 
     def fixup(self, install_paths):
         """
@@ -392,26 +522,24 @@ class Wheel:
         Compiles all Python sources.
         """
         root = os.path.dirname(self.distinfo_location(install_paths))
-        # Read the RECORDS
-        records = list(self.records())
-        # Get a list of Python files (and a set for quick membership tests)
-        py_files = [
-            os.path.normpath(os.path.join(root, record))
-            for record, _, _ in records
-            if record.endswith(".py")
-        ]
-        py_set = set(py_files)
-        # Write the new RECORDS file, excluding .pyc files
+        # Sort the records into Python files, compiled Python files, and the
+        # rest in a single pass, normalizing each path only once.
+        py_files = []
+        pyc_records = []
         new_records = []
-        for record_line in records:
-            record, _, _ = record_line
-            # Add non-pyc files and continue
-            is_py = record.endswith(".py")
-            if is_py or not any(record.endswith(e) for e in PYTHON_EXTS):
-                new_records.append(record_line)
+        for record_line in self.records():
+            record = record_line[0]
+            if record.endswith(".py"):
+                py_files.append(os.path.normpath(os.path.join(root, record)))
+            elif record.endswith(_COMPILED_PYTHON_EXTS):
+                pyc_records.append(record_line)
                 continue
+            new_records.append(record_line)
+        # Only keep the .pyc files that have no .py file
+        py_set = set(py_files)
+        for record_line in pyc_records:
             # We have a pyc file, delete it if the .py file exists.
-            pyc_file = os.path.normpath(os.path.join(root, record))
+            pyc_file = os.path.normpath(os.path.join(root, record_line[0]))
             try:
                 py_file = source_from_cache(pyc_file)
                 if py_file in py_set:
@@ -437,3 +565,4 @@ class Wheel:
         with open(records_path, "wt") as f:
             writer = csv.writer(f)
             writer.writerows(new_records)
+        self._records = None
@@ -0,0 +1,56 @@
+# Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree.
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import unittest
+
+from xar import bootstrap_py, compat
+
+
+class BootstrapPyTest(unittest.TestCase):
+    def test_bootstrap_xar(self):
+        bootstrap_xar = bootstrap_py.bootstrap_xar(
+            "/usr/bin/python", bootstrap_py.RUN_XAR_MAIN
+        )
+        self.assertIsInstance(bootstrap_xar, bytes)
+        self.assertTrue(bootstrap_xar.startswith(b"#!/bin/sh -eu\n"))
+        self.assertIn(b'export XAR_PYTHON_COMMAND="/usr/bin/python"\n', bootstrap_xar)
+        self.assertTrue(
+            bootstrap_xar.endswith(
+                b'\nexec /usr/bin/python "$DIR/__run_xar_main__.py" "$@"\n'
+            )
+        )
+        self.assertIn(b'path="${path%/}"\n', bootstrap_xar)
+
+    def test_run_xar_main_function(self):
+        run_xar_main = bootstrap_py.run_xar_main(
+            python="/usr/bin/python", module="path.to.module", function="main"
+        )
+        compile(run_xar_main, bootstrap_py.RUN_XAR_MAIN, "exec")
+        self.assertIn("    import path.to.module\n", run_xar_main)
+        self.assertIn("    path.to.module.main()\n", run_xar_main)
+        self.assertNotIn("_run_module_as_main", run_xar_main)
+
+    def test_run_xar_main_module(self):
+        run_xar_main = bootstrap_py.run_xar_main(
+            python="/usr/bin/python", module="path.to.module"
+        )
+        compile(run_xar_main, bootstrap_py.RUN_XAR_MAIN, "exec")
+        self.assertIn('    module = "path.to.module"\n', run_xar_main)
+        self.assertIn("runpy._run_module_as_main(module, False)", run_xar_main)
+
+    def test_run_xar_main_future_imports(self):
+        run_xar_main = bootstrap_py.run_xar_main(
+            python="/usr/bin/python", module="path.to.module"
+        )
+        if compat.PY2:
+            self.assertIn("from __future__ import", run_xar_main)
+        else:
+            self.assertNotIn("from __future__ import", run_xar_main)
+
+
+if __name__ == "__main__":
+    unittest.main()
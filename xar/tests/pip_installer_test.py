@@ -11,6 +11,7 @@ import subprocess
 import sys
 import tempfile
 import unittest
+import zipfile
 
 import pkg_resources
 from xar import pip_installer, xar_util
@@ -40,6 +41,7 @@ setup(
 class PyUtilTest(unittest.TestCase):
     def setUp(self):
         self.src = tempfile.mkdtemp()
+        self.addCleanup(xar_util.safe_rmtree, self.src)
         setup_py = os.path.join(self.src, "setup.py")
         xar_util.safe_mkdir(os.path.join(self.src, "hello"))
         with open(os.path.join(self.src, "README"), "w") as f:
@@ -63,10 +65,7 @@ class PyUtilTest(unittest.TestCase):
             self.sdist = os.path.join(dist_dir, dists[0])
         self.req = pkg_resources.Requirement("hello")
         self.dst = tempfile.mkdtemp()
-
-    def tearDown(self):
-        xar_util.safe_rmtree(self.src)
-        xar_util.safe_rmtree(self.dst)
+        self.addCleanup(xar_util.safe_rmtree, self.dst)
 
     def mock_download_sdist(self, _req):
         shutil.copy(self.sdist, self._dest)
@@ -74,6 +73,76 @@ class PyUtilTest(unittest.TestCase):
     def mock_download_wheel(self, _req):
         shutil.copy(self.wheel, self._dest)
 
+    def mock_download_many_wheel(self, reqs):
+        self.downloaded.append(reqs)
+        shutil.copy(self.wheel, self._dest)
+
+    @mock.patch.object(
+        pip_installer.PipInstaller, "download_many", mock_download_many_wheel
+    )
+    def test_pip_prefetch(self):
+        working_set = pkg_resources.WorkingSet(sys.path)
+        installer = pip_installer.PipInstaller(self.dst, working_set)
+        installer.downloaded = []
+        installer.wheel = self.wheel
+        setuptools_req = pkg_resources.Requirement("setuptools")
+        installer.prefetch([self.req, setuptools_req])
+        # Only the missing requirement is downloaded
+        self.assertEqual(installer.downloaded, [[self.req]])
+        self.assertTrue(working_set.find(self.req) in self.req)
+        # Nothing is missing anymore
+        installer.prefetch([self.req, setuptools_req])
+        self.assertEqual(len(installer.downloaded), 1)
+
+    def _write_wheel(self, version):
+        dist_info = "hello-%s.dist-info" % version
+        wheel = os.path.join(self.dst, "hello-%s-py2.py3-none-any.whl" % version)
+        with zipfile.ZipFile(wheel, "w") as zf:
+            zf.writestr("hello/__init__.py", "")
+            zf.writestr(
+                dist_info + "/METADATA",
+                "Metadata-Version: 2.1\nName: hello\nVersion: %s\n" % version,
+            )
+            zf.writestr(
+                dist_info + "/WHEEL",
+                "Wheel-Version: 1.0\nRoot-Is-Purelib: true\nTag: py2-none-any\n",
+            )
+            zf.writestr(dist_info + "/RECORD", "")
+
+    @mock.patch.object(
+        pip_installer.PipInstaller, "download_many", mock_download_many_wheel
+    )
+    def test_pip_download_cache(self):
+        # A cache with several versions of a project
+        self._write_wheel("1.0")
+        self._write_wheel("2.0")
+        for spec, version in (("hello<2", "1.0"), ("hello>=2", "2.0")):
+            working_set = pkg_resources.WorkingSet([])
+            installer = pip_installer.PipInstaller(self.dst, working_set)
+            installer.downloaded = []
+            req = pkg_resources.Requirement.parse(spec)
+            installer.prefetch([req])
+            self.assertEqual(working_set.find(req).version, version)
+            self.assertEqual(installer(req).version, version)
+            # pip isn't run
+            self.assertEqual(installer.downloaded, [])
+
+    @mock.patch.object(pip_installer.PipInstaller, "download", mock_download_sdist)
+    def test_pip_install_keeps_other_files(self):
+        other = os.path.join(self.dst, "other-1.0.tar.gz")
+        shutil.copy(self.sdist, other)
+        working_set = pkg_resources.WorkingSet(sys.path)
+        installer = pip_installer.PipInstaller(self.dst, working_set)
+        installer.sdist = self.sdist
+        dist = installer(self.req)
+        self.assertTrue(dist in self.req)
+        installer.clean()
+        # Only the downloaded sdist is built and removed
+        self.assertEqual(
+            sorted(os.listdir(self.dst)),
+            sorted([os.path.basename(other), os.path.basename(self.wheel)]),
+        )
+
     @mock.patch.object(pip_installer.PipInstaller, "download", mock_download_wheel)
     def test_pip_install_wheel(self):
         working_set = pkg_resources.WorkingSet(sys.path)
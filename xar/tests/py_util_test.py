@@ -23,6 +23,12 @@ TESTWHEEL = os.path.join(THISDIR, "test-1.0-py2.py3-none-win32.whl")
 
 
 class PyUtilTest(unittest.TestCase):
+    def _mkdtemp(self):
+        """Returns a temporary directory, removed when the test is done."""
+        path = tempfile.mkdtemp()
+        self.addCleanup(xar_util.safe_rmtree, path)
+        return path
+
     def test_environment_python_interpreter(self):
         interpreter = py_util.environment_python_interpreter()
         self.assertTrue(interpreter.startswith("/usr/bin/env"))
@@ -110,9 +116,9 @@ class PyUtilTest(unittest.TestCase):
             ]
         )
 
-        src = tempfile.mkdtemp()
+        src = self._mkdtemp()
+        dst = self._mkdtemp()
         os.mkdir(os.path.join(src, "xar"))
-        dst = tempfile.mkdtemp()
 
         for file, _, _ in wheel.records():
             with open(os.path.join(src, file), "wb") as f:
@@ -120,17 +126,17 @@ class PyUtilTest(unittest.TestCase):
 
         wheel.copy_installation(self._temppaths(src), self._temppaths(dst))
 
-        for file, hash, _ in wheel.records():
+        def does_record_match(record):
+            file, hash, _ = record
             dst_file = os.path.join(dst, file)
             self.assertTrue(os.path.exists(dst_file))
-            matches = py_util.does_sha256_match(dst_file, hash)
-            if hash:
-                self.assertTrue(matches)
-            else:
-                self.assertFalse(matches)
+            return py_util.does_sha256_match(dst_file, hash)
 
-        xar_util.safe_rmtree(src)
-        xar_util.safe_rmtree(dst)
+        # Hash the copies concurrently, hashlib releases the GIL.
+        records = wheel.records()
+        matches = xar_util.thread_map(does_record_match, records)
+        for (_, hash, _), match in zip(records, matches):
+            self.assertEqual(match, bool(hash))
 
     def test_wheel_sys_install_paths(self):
         print(TESTWHEEL)
@@ -144,6 +150,29 @@ class PyUtilTest(unittest.TestCase):
         wheel = py_util.Wheel(location=TESTWHEEL)
         self.assertFalse(wheel.is_purelib())
 
+    def test_wheel_metadata_cached(self):
+        wheel = py_util.Wheel(location=TESTWHEEL)
+        metadata = wheel.distribution._provider
+        wheel_info = metadata.get_metadata(py_util.Wheel.WHEEL_INFO)
+        with mock.patch.object(metadata, "_get", side_effect=AssertionError):
+            self.assertEqual(wheel_info, metadata.get_metadata(wheel.WHEEL_INFO))
+            self.assertFalse(wheel.is_purelib())
+
+    def test_compile_files(self):
+        src = self._mkdtemp()
+        # Enough files to compile them in parallel
+        py_files = []
+        for i in range(py_util._PARALLEL_COMPILE_MIN_FILES + 1):
+            py_files.append(os.path.join(src, "mod%d.py" % i))
+            with open(py_files[-1], "w") as f:
+                f.write("x = %d\n" % i if i != 1 else "def (:\n")
+        for files in (py_files[:2], py_files):
+            errors = py_util.compile_files(files)
+            self.assertEqual(list(errors), [py_files[1]])
+            for py_file in files:
+                pyc_file = py_util.get_pyc_file(py_file)
+                self.assertEqual(os.path.exists(pyc_file), py_file != py_files[1])
+
     def _check_install(self, paths):
         def assertExists(*path):
             self.assertTrue(os.path.exists(os.path.join(*path)))
@@ -160,7 +189,7 @@ class PyUtilTest(unittest.TestCase):
         print(TESTWHEEL)
         self.assertTrue(py_util.Wheel.is_wheel_archive(TESTWHEEL))
         wheel = py_util.Wheel(location=TESTWHEEL)
-        dst = tempfile.mkdtemp()
+        dst = self._mkdtemp()
         paths = self._temppaths(dst)
 
         # Install without force
@@ -171,12 +200,10 @@ class PyUtilTest(unittest.TestCase):
         wheel.install_archive(paths, force=True)
         self._check_install(paths)
 
-        xar_util.safe_rmtree(dst)
-
     def test_wheel_install(self):
         archived_wheel = py_util.Wheel(location=TESTWHEEL)
-        src = tempfile.mkdtemp()
-        dst = tempfile.mkdtemp()
+        src = self._mkdtemp()
+        dst = self._mkdtemp()
         src_paths = self._temppaths(src)
         dst_paths = self._temppaths(dst)
 
@@ -194,6 +221,3 @@ class PyUtilTest(unittest.TestCase):
         # Reinstall copy to dst with force
         installed_wheel.install(src_paths, dst_paths, force=True)
         self._check_install(dst_paths)
-
-        xar_util.safe_rmtree(src)
-        xar_util.safe_rmtree(dst)
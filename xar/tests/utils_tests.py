@@ -19,12 +19,7 @@ except ImportError:
 class XarUtilsTestCase(unittest.TestCase):
     def setUp(self):
         self.tempdir = tempfile.mkdtemp()
-
-    def tearDown(self):
-        try:
-            rmtree(self.tempdir)
-        except OSError:
-            pass
+        self.addCleanup(rmtree, self.tempdir, True)
 
     def test_get_runtime_path(self):
         with mock.patch("xar.utils.os.getenv") as fake_env:
@@ -7,33 +7,63 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 
 import copy
 import os
+import tempfile
 
 from xar import xar_builder, xar_util
 from xar.tests import xar_test_helpers
 
 
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+
+_TMPFS = "/dev/shm"
+
+
 class XarBuilderTest(xar_test_helpers.XarTestCase):
+    # A set of files for testing
+    files = {
+        "executable.sh": ("executable.sh", "#!echo executable", "w", 0o755),
+        "lib.so": ("lib.so", b"binary source", "wb", 0o644),
+        "source.txt": ("source.txt", "text source", "w", 0o644),
+        "subdir/source.txt": ("subdir/source.txt", "subdir", "w", 0o644),
+    }
+
+    @classmethod
+    def setUpClass(cls):
+        # Everything these tests write is small and short lived, so keep it
+        # in memory when there is a tmpfs to put it on.
+        cls._tempdir = tempfile.tempdir
+        cls._tmpfs = None
+        if os.path.isdir(_TMPFS) and os.access(_TMPFS, os.W_OK):
+            cls._tmpfs = tempfile.mkdtemp(prefix="xar-test-", dir=_TMPFS)
+            tempfile.tempdir = cls._tmpfs
+        # No test modifies the source files, so they are written once and
+        # shared by every test.
+        cls.src = xar_util.StagingDirectory()
+        for filename, data, mode, permissions in cls.files.values():
+            cls.src.write(data, filename, mode, permissions)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.src.delete()
+        tempfile.tempdir = cls._tempdir
+        if cls._tmpfs is not None:
+            xar_util.safe_rmtree(cls._tmpfs)
+
     def setUp(self):
         self.xar_builder = xar_builder.XarBuilder()
         self.sqopts = xar_util.SquashfsOptions()
         self.sqopts.compression_algorithm = "gzip"
-        self.src = xar_util.StagingDirectory()
-        # A set of files for testing
-        self.files = {
-            "executable.sh": ("executable.sh", "#!echo executable", "w", 0o755),
-            "lib.so": ("lib.so", b"binary source", "wb", 0o644),
-            "source.txt": ("source.txt", "text source", "w", 0o644),
-            "subdir/source.txt": ("subdir/source.txt", "subdir", "w", 0o644),
-        }
-        for filename, data, mode, permissions in self.files.values():
-            self.src.write(data, filename, mode, permissions)
+        for filename, _, _, permissions in self.files.values():
             self.assertEqual(
                 xar_test_helpers.mode(self.src.absolute(filename)), permissions
             )
 
     def tearDown(self):
         self.xar_builder.delete()
-        self.src.delete()
 
     def _set_xar_builder(self, xar_builder):
         self.xar_builder.delete()
@@ -198,6 +228,36 @@ class XarBuilderTest(xar_test_helpers.XarTestCase):
         self.assertDirectoryEqual(self.src.path(), test_root)
         dst.delete()
 
+    def test_build_failure(self):
+        self.xar_builder.add_directory(self.src.path())
+        self.xar_builder.partition_by_extension([".txt"])
+        dst = xar_util.StagingDirectory()
+        test_xar = os.path.join(dst.path(), "test.xar")
+        with mock.patch.object(
+            self.xar_builder, "_build_staging_dirs", side_effect=RuntimeError
+        ):
+            with self.assertRaises(RuntimeError):
+                self.xar_builder.build(test_xar, self.sqopts)
+        # No temporary XARs are left in the output directory
+        self.assertEqual(os.listdir(dst.path()), [])
+        dst.delete()
+
+    def test_partition_build(self):
+        self.xar_builder.add_directory(self.src.path())
+        self.xar_builder.partition_by_extension([".txt"])
+        dst = xar_util.StagingDirectory()
+        test_xar = os.path.join(dst.path(), "test.xar")
+        test_txt_xar = os.path.join(dst.path(), "test.txt.xar")
+        self.xar_builder.build(test_xar, self.sqopts)
+        with open(test_xar, "rb") as f:
+            self.assertIn(b'DEPENDENCIES="test.txt.xar"\n', f.read(4096))
+        test_root = os.path.join(dst.path(), "squashfs-root")
+        self._unxar(test_txt_xar, test_root)
+        self.assertEqual(
+            sorted(os.listdir(test_root)), sorted(["source.txt", "subdir"])
+        )
+        dst.delete()
+
     def test_deepcopy(self):
         other = copy.deepcopy(self.xar_builder)
         self.assertEqual(other._sort_file, None)
@@ -212,3 +272,23 @@ class XarBuilderTest(xar_test_helpers.XarTestCase):
         )
         self.assertNotEqual(other._sort_file.name(), self.xar_builder._sort_file.name())
         other.delete()
+
+    def test_clone(self):
+        self.xar_builder.add_directory(self.src.path())
+        self.xar_builder.sort_by_extension([".txt", ".so", ""])
+        other = self.xar_builder.clone()
+        self.assertNotEqual(
+            other._staging.absolute(), self.xar_builder._staging.absolute()
+        )
+        self.assertDirectoryEqual(self._staging().path(), other._staging.path())
+        self.assertEqual(other._priorities, self.xar_builder._priorities)
+        self.assertFalse(other._priorities is self.xar_builder._priorities)
+        self.assertEqual(other._xar_exec, self.xar_builder._xar_exec)
+        # Changes to the clone don't affect the original
+        other.add_file(self._src_file("source.txt"), "cloned.txt")
+        self.assertFalse(self._staging().exists("cloned.txt"))
+        other.delete()
+        # Can't clone once frozen
+        self.xar_builder.freeze()
+        with self.assertRaises(xar_builder.XarBuilder.FrozenError):
+            self.xar_builder.clone()
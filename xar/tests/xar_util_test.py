@@ -146,6 +146,31 @@ class XarUtilTest(xar_test_helpers.XarTestCase):
             if filename.endswith(".mp3"):
                 self.assertEqual(priority, "-2")
 
+    def test_write_sort_file_unlisted_extension(self):
+        source_dir = self.make_test_skeleton()
+        sort_file = io.StringIO()
+        xar_util.write_sort_file(source_dir, [".debuginfo"], sort_file)
+        sort_data = [
+            line.split(" ") for line in sort_file.getvalue().strip().split("\n")
+        ]
+        # Files without a listed extension keep the default priority.
+        self.assertEqual(len(sort_data), 7)
+        for filename, priority in sort_data:
+            self.assertTrue(filename.endswith(".debuginfo"))
+            self.assertEqual(priority, "-2")
+
+    def test_thread_map(self):
+        self.assertEqual(xar_util.thread_map(abs, []), [])
+        self.assertEqual(xar_util.thread_map(abs, [-1]), [1])
+        self.assertEqual(xar_util.thread_map(abs, range(-5, 0)), [5, 4, 3, 2, 1])
+        with self.assertRaises(TypeError):
+            xar_util.thread_map(abs, [-1, "2"])
+
+    def test_process_map(self):
+        self.assertEqual(
+            xar_util.process_map(abs, range(-5, 0), chunksize=2), [5, 4, 3, 2, 1]
+        )
+
     def test_staging_deepcopy(self):
         original = xar_util.StagingDirectory(self.make_test_skeleton())
         clone = copy.deepcopy(original)
@@ -173,6 +198,35 @@ class XarUtilTest(xar_test_helpers.XarTestCase):
         with self.assertRaises(Exception):
             xar.go()
 
+    def test_mksquashfs_compressors(self):
+        "Test parsing the compressors out of mksquashfs -help"
+        with tempfile.NamedTemporaryFile("w", delete=False) as f:
+            f.write(
+                "#!/bin/sh\n"
+                "cat >&2 <<EOF\n"
+                "SYNTAX:mksquashfs source1 source2 ...  dest [options]\n"
+                "-comp <comp>\t\tselect <comp> compression\n"
+                "\n"
+                "Compressors available and compressor specific options:\n"
+                "\tgzip (default)\n"
+                "\t  -Xcompression-level <compression-level>\n"
+                "\t\t<compression-level> should be 1 .. 9 (default 9)\n"
+                "\tlzo\n"
+                "\t  -Xalgorithm <algorithm>\n"
+                "\t\t\tlzo1x_1\n"
+                "\tzstd\n"
+                "\t  -Xcompression-level <compression-level>\n"
+                "EOF\n"
+                "exit 1\n"
+            )
+        os.chmod(f.name, 0o755)
+        compressors = xar_util.mksquashfs_compressors(f.name)
+        self.assertEqual(compressors, frozenset(("gzip", "lzo", "zstd")))
+        os.unlink(f.name)
+        # The result is cached
+        self.assertEqual(xar_util.mksquashfs_compressors(f.name), compressors)
+        self.assertEqual(xar_util.mksquashfs_compressors(f.name + ".bogus"), set())
+
     def make_test_skeleton(self):
         "Make a simple tree of test files"
         srcdir = tempfile.mkdtemp()
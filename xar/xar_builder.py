@@ -5,6 +5,7 @@
 
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+import copy
 import os
 import shutil
 import sys
@@ -60,6 +61,24 @@ class XarBuilder:
         self._sort_file = None
         self._partition_dest = {}
 
+    def clone(self):
+        """
+        Returns a new unfrozen XarBuilder with a copy of this builder's staging
+        directory and settings. This is much cheaper than `copy.deepcopy()`,
+        since only the staging directory is copied and the rest of the state
+        is copied shallowly.
+        """
+        self._ensure_unfrozen()
+        other = self.__class__(self._xar_exec, self._mount_root)
+        other._staging.copytree(self._staging.path())
+        other._executable = self._executable
+        other._shebang = self._shebang
+        if self._priorities is not None:
+            other._priorities = list(self._priorities)
+        if self._partition is not None:
+            other._partition = list(self._partition)
+        return other
+
     def _ensure_frozen(self):
         if not self._frozen:
             raise self.FrozenError("Expected to be frozen")
@@ -223,6 +242,22 @@ class XarBuilder:
         xar.squashfs_options = squashfs_options
         xar.go()
 
+    def _build_staging_dirs(self, builds, squashfs_options):
+        """
+        Builds each `(staging_dir, filename, shebang, xar_header)` in `builds`.
+        mksquashfs does the work, so threads are enough to run them in
+        parallel. The processors, all of them unless `squashfs_options` limits
+        them, are split between them.
+        """
+        if len(builds) > 1:
+            squashfs_options = copy.copy(squashfs_options)
+            processors = squashfs_options.processors or xar_util.cpu_count()
+            squashfs_options.processors = max(1, processors // len(builds))
+        xar_util.thread_map(
+            lambda build: self._build_staging_dir(*(build + (squashfs_options,))),
+            builds,
+        )
+
     def _build_xar_header(self, xar_dependencies):
         """Make the XAR headers."""
         self._ensure_frozen()
@@ -249,30 +284,37 @@ class XarBuilder:
             self.freeze()
         xarfiles = {}
         base_name, xar_ext = os.path.splitext(filename)
-        # Build the dependent XARs
-        for ext, destination in self._partition_dest:
-            ext_filename = base_name + ext + xar_ext
-            with tempfile.NamedTemporaryFile(delete=False) as tf:
-                xarfiles[ext] = (ext_filename, tf.name)
-            self._build_staging_dir(
-                destination.staging,
-                xarfiles[ext][1],
-                BORING_SHEBANG,
-                {},
-                squashfs_options,
-            )
-        # Build the main XAR
-        with tempfile.NamedTemporaryFile(delete=False) as tf:
-            tmp_xar = tf.name
-        xar_header = self._build_xar_header(xarfiles)
-        self._build_staging_dir(
-            self._staging, tmp_xar, self._shebang, xar_header, squashfs_options
-        )
-
-        # Move the results into place
-        shutil.move(tmp_xar, filename)
-        for ext_filename, tmp_filename in xarfiles.values():
-            shutil.move(tmp_filename, ext_filename)
+        # Build next to the output so that moving the results into place is a
+        # rename, rather than a copy if the temporary directory is on another
+        # filesystem.
+        output_dir = os.path.dirname(os.path.abspath(filename))
+        # The dependent XARs and the main XAR are independent, so they are
+        # all built at once.
+        builds = []
+        tmp_files = []
+        try:
+            for ext, destination in self._partition_dest.items():
+                ext_filename = base_name + ext + xar_ext
+                with tempfile.NamedTemporaryFile(dir=output_dir, delete=False) as tf:
+                    tmp_files.append(tf.name)
+                    xarfiles[ext] = (ext_filename, tf.name)
+                builds.append((destination.staging, tf.name, BORING_SHEBANG, {}))
+            with tempfile.NamedTemporaryFile(dir=output_dir, delete=False) as tf:
+                tmp_files.append(tf.name)
+                tmp_xar = tf.name
+            xar_header = self._build_xar_header(list(xarfiles.values()))
+            builds.append((self._staging, tmp_xar, self._shebang, xar_header))
+            self._build_staging_dirs(builds, squashfs_options)
+
+            # Move the results into place
+            shutil.move(tmp_xar, filename)
+            for ext_filename, tmp_filename in xarfiles.values():
+                shutil.move(tmp_filename, ext_filename)
+        finally:
+            # Only a failed build leaves any of these behind, and they are in
+            # the output directory.
+            for tmp_filename in tmp_files:
+                xar_util.safe_remove(tmp_filename)
 
         # Make the output executable if necessary
         if self._executable is not None:
@@ -311,6 +353,14 @@ class PythonXarBuilder(XarBuilder):
 
         super(PythonXarBuilder, self).__init__(*args, **kwargs)
 
+    def clone(self):
+        """See :func:`XarBuilder.clone`. Also copies the Python settings."""
+        other = super(PythonXarBuilder, self).clone()
+        other._entry_point = self._entry_point
+        other._interpreter = self._interpreter
+        other._distributions = set(self._distributions)
+        return other
+
     def _validate_entry_point(self, entry_point):
         """Validates that the module specified in `entry_point` exists."""
 
@@ -389,12 +439,16 @@ class PythonXarBuilder(XarBuilder):
         sys_paths = wheel.sys_install_paths()
         xar_paths = self._xar_install_paths(wheel.name, absolute=True)
         wheel.install(sys_paths, xar_paths, force=False)
-        self._distributions.add(wheel.distinfo_location(xar_paths))
+        # Track the location relative to the staging directory, so that it is
+        # still valid in clones of this XarBuilder.
+        rel_paths = self._xar_install_paths(wheel.name, absolute=False)
+        self._distributions.add(wheel.distinfo_location(rel_paths))
 
     def _fixup_distributions(self):
         """Fixup the distributions."""
         for distinfo_location in self._distributions:
-            wheel = py_util.Wheel(location=distinfo_location)
+            location = self._staging.absolute(distinfo_location)
+            wheel = py_util.Wheel(location=location)
             xar_paths = self._xar_install_paths(wheel.name, absolute=True)
             wheel.fixup(xar_paths)
 
@@ -413,11 +467,13 @@ class PythonXarBuilder(XarBuilder):
         }
         if function is not None:
             fmt_args["function"] = function
-        bootstrap_xar = bootstrap_py.BOOTSTRAP_XAR_TEMPLATE.format(**fmt_args)
+        bootstrap_xar = bootstrap_py.bootstrap_xar(
+            self._interpreter, bootstrap_py.RUN_XAR_MAIN
+        )
         run_xar_main = bootstrap_py.run_xar_main(**fmt_args)
 
         self._staging.write(
-            bootstrap_xar, bootstrap_py.BOOTSTRAP_XAR, mode="w", permissions=0o755
+            bootstrap_xar, bootstrap_py.BOOTSTRAP_XAR, mode="wb", permissions=0o755
         )
         self._staging.write(
             run_xar_main, bootstrap_py.RUN_XAR_MAIN, mode="w", permissions=0o644
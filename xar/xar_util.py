@@ -50,12 +50,46 @@ def find_mksquashfs():
     return "mksquashfs"
 
 
+_MKSQUASHFS_COMPRESSORS = {}
+_KNOWN_COMPRESSORS = frozenset(("gzip", "lz4", "lzma", "lzo", "xz", "zstd"))
+
+
+def mksquashfs_compressors(mksquashfs):
+    """
+    Returns the set of compression algorithms supported by the `mksquashfs`
+    binary, parsed from its help output. The result is cached per binary.
+    """
+    if mksquashfs in _MKSQUASHFS_COMPRESSORS:
+        return _MKSQUASHFS_COMPRESSORS[mksquashfs]
+    try:
+        proc = subprocess.Popen(
+            [mksquashfs, "-help"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+        )
+        output, _ = proc.communicate()
+    except OSError:
+        output = b""
+    compressors = set()
+    in_compressors = False
+    for line in output.decode("utf-8", "replace").splitlines():
+        if line.startswith("Compressors available"):
+            in_compressors = True
+        elif in_compressors and line.strip():
+            name = line.split()[0]
+            if name in _KNOWN_COMPRESSORS:
+                compressors.add(name)
+    _MKSQUASHFS_COMPRESSORS[mksquashfs] = frozenset(compressors)
+    return _MKSQUASHFS_COMPRESSORS[mksquashfs]
+
+
 class SquashfsOptions:
     def __init__(self, mksquashfs=None):
         self.mksquashfs = mksquashfs or find_mksquashfs()
         self.compression_algorithm = "zstd"
         self.zstd_level = 16
         self.block_size = 256 * 1024
+        # Number of processors mksquashfs may use, None lets mksquashfs decide
+        # (it uses all of them by default).
+        self.processors = None
 
 
 class XarFactory:
@@ -105,6 +139,8 @@ class XarFactory:
         ]
         if sqopts.compression_algorithm == "zstd":
             cmd.extend(("-Xcompression-level", str(sqopts.zstd_level)))
+        if sqopts.processors is not None:
+            cmd.extend(("-processors", str(sqopts.processors)))
 
         if self.sort_file:
             cmd.extend(["-sort", self.sort_file])
@@ -168,6 +204,62 @@ def safe_rmtree(directory):
         shutil.rmtree(directory, True)
 
 
+def cpu_count():
+    """
+    Returns the number of processors, or 1 if it can't be determined. Python 2
+    has no os.cpu_count(), and multiprocessing is only imported there.
+    """
+    count = os.cpu_count() if hasattr(os, "cpu_count") else None
+    if count is None:
+        import multiprocessing
+
+        try:
+            count = multiprocessing.cpu_count()
+        except NotImplementedError:
+            count = 1
+    return count
+
+
+def _parallel_map(executor_name, fn, items, max_workers, **map_kwargs):
+    items = list(items)
+    executor_cls = None
+    if len(items) > 1:
+        # Python 2 only has concurrent.futures if the futures backport is
+        # installed, otherwise the items are mapped one at a time.
+        try:
+            import concurrent.futures
+
+            executor_cls = getattr(concurrent.futures, executor_name)
+        except ImportError:
+            pass
+    if executor_cls is None:
+        return [fn(item) for item in items]
+    if max_workers is None:
+        max_workers = min(len(items), cpu_count())
+    with executor_cls(max_workers=max_workers) as executor:
+        return list(executor.map(fn, items, **map_kwargs))
+
+
+def thread_map(fn, items, max_workers=None):
+    """
+    Returns `[fn(item) for item in items]`, calling `fn` from a pool of
+    threads when there is more than one item. Raises the first exception
+    raised by `fn`.
+    """
+    return _parallel_map("ThreadPoolExecutor", fn, items, max_workers)
+
+
+def process_map(fn, items, max_workers=None, chunksize=1):
+    """
+    Like :func:`thread_map`, but with a pool of processes, so `fn`, the items
+    and the results must be picklable. `chunksize` items are sent to a worker
+    at a time.
+    """
+    return _parallel_map(
+        "ProcessPoolExecutor", fn, items, max_workers, chunksize=chunksize
+    )
+
+
 # Simplified version of Chroot from PEX
 class StagingDirectory:
     """
@@ -227,9 +319,15 @@ class StagingDirectory:
         dst = self._normalize(dst)
         self._ensure_parent(dst)
         self._ensure_not_dst(dst)
-        with open(self.absolute(dst), mode) as f:
+        # Set the permissions through the new file descriptor rather than
+        # resolving the path again with os.chmod(). fchmod() is still needed
+        # because the mode passed to os.open() is subject to the umask.
+        fd = os.open(
+            self.absolute(dst), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, permissions
+        )
+        with os.fdopen(fd, mode) as f:
+            os.fchmod(fd, permissions)
             f.write(data)
-        os.chmod(self.absolute(dst), permissions)
 
     @contextlib.contextmanager
     def postprocess(self, src):
@@ -366,44 +464,54 @@ def partition_files(staging, extension_destinations):
     "../../../uuid/path/to/file" so that the final symlinks are correct
     relative to /mnt/xar/....
     """
-    source_dir = staging.path()
-    source_dir = source_dir.rstrip("/")
-
-    for dirpath, _dirnames, filenames in os.walk(staging.path()):
-        # path relative to source_dir; used for creating the right
-        # file inside the staging dir
-        relative_dirname = dirpath[len(source_dir) + 1 :]
-
-        # Special case; if a file is in the root of source_dir, then
-        # relative_dirname is empty, but that has the same number of
-        # '/' as just 'bin', so we need to special case it the empty
-        # value.
-        if not relative_dirname:
-            relative_depth = 1
-        else:
-            relative_depth = 2 + relative_dirname.count("/")
-
-        for filename in filenames:
-            # Does this extension map to a separate output?
-            _, extension = os.path.splitext(filename)
-            dest_base = extension_destinations.get(extension, None)
-            # This path stays in the source staging directory
-            if dest_base is None:
-                continue
-            # This file is destined for another tree, make a
-            # relative symlink in source pointing to the
-            # sub-xar destination.
-            relative_path = os.path.join(relative_dirname, filename)
-            source_path = staging.absolute(relative_path)
-            dest_base.staging.move(source_path, relative_path)
-
-            dependency_mountpoint = dest_base.uuid
-            staging_symlink = os.path.join(
-                "../" * relative_depth, dependency_mountpoint, relative_path
-            )
-            logging.info("%s %s" % (staging_symlink, source_path))
-
-            staging.symlink(staging_symlink, relative_path)
+    # The tree is listed up front since the loop replaces files with symlinks.
+    for relative_path in list(_walk_files(staging.path())):
+        # Does this extension map to a separate output?
+        _, extension = os.path.splitext(relative_path)
+        dest_base = extension_destinations.get(extension, None)
+        # This path stays in the source staging directory
+        if dest_base is None:
+            continue
+        # This file is destined for another tree, make a
+        # relative symlink in source pointing to the
+        # sub-xar destination.
+        source_path = staging.absolute(relative_path)
+        dest_base.staging.move(source_path, relative_path)
+
+        # A file in the root of the staging directory needs one '../', and
+        # every directory it is nested in needs one more.
+        relative_depth = 1 + relative_path.count("/")
+        dependency_mountpoint = dest_base.uuid
+        staging_symlink = os.path.join(
+            "../" * relative_depth, dependency_mountpoint, relative_path
+        )
+        logging.info("%s %s" % (staging_symlink, source_path))
+
+        staging.symlink(staging_symlink, relative_path)
+
+
+def _walk_files(directory, prefix=""):
+    """
+    Yields the path, relative to directory, of every file under it. Like
+    os.walk(), symlinks to directories are neither followed nor listed.
+    """
+    if not hasattr(os, "scandir"):
+        # Python 2
+        for dirpath, _dirnames, filenames in os.walk(directory):
+            relative_dir = os.path.relpath(dirpath, directory)
+            for filename in filenames:
+                if relative_dir == ".":
+                    yield prefix + filename
+                else:
+                    yield prefix + os.path.join(relative_dir, filename)
+        return
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if not entry.is_dir():
+                yield prefix + entry.name
+            elif not entry.is_symlink():
+                for path in _walk_files(entry.path, prefix + entry.name + "/"):
+                    yield path
 
 
 def write_sort_file(staging_dir, extension_priorities, sort_file):
@@ -413,26 +521,24 @@ def write_sort_file(staging_dir, extension_priorities, sort_file):
     appearing first. The result is written to the file object sort_file.
     mksquashfs takes the sort file with the option '-sort sort_filename'.
     """
-    for dirpath, _dirname, filenames in os.walk(staging_dir):
-        for filename in filenames:
-            fn = os.path.join(dirpath, filename)
-            for idx, suffix in enumerate(extension_priorities):
-                if fn.endswith(suffix):
-                    # Default priority is 0; make ours all
-                    # negative so we can not list files with
-                    # spaces in the name, making them default
-                    # to 0
-                    priority = idx - len(extension_priorities) - 1
-                    break
-
-            assert fn.startswith(staging_dir + "/")
-            fn = fn[len(staging_dir) + 1 :]
-
-            # Older versions of mksquashfs don't like spaces
-            # in filenames; let them have the default priority
-            # of 0.
-            if " " not in fn:
-                sort_file.write("%s %d\n" % (fn, priority))
+    # Default priority is 0; make ours all negative so we can not list files
+    # with spaces in the name, or without a listed extension, making them
+    # default to 0.
+    priorities = [
+        (suffix, idx - len(extension_priorities) - 1)
+        for idx, suffix in enumerate(extension_priorities)
+    ]
+    lines = []
+    for fn in _walk_files(staging_dir):
+        # Older versions of mksquashfs don't like spaces in filenames; let
+        # them have the default priority of 0.
+        if " " in fn:
+            continue
+        for suffix, priority in priorities:
+            if fn.endswith(suffix):
+                lines.append("%s %d\n" % (fn, priority))
+                break
+    sort_file.writelines(lines)
 
 
 def extract_pyc_timestamp(path):